@@ -1,8 +1,11 @@
+import os
+
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 
 
-def flatten(dataloader: DataLoader):
+def flatten(dataloader: DataLoader, memmap_dir=None):
     """
     Combines batches from a DataLoader into a single tensor. If
     there are multiple tensors returned in each batch, they will be
@@ -13,33 +16,125 @@ def flatten(dataloader: DataLoader):
     this function will return a tuple of two tensors of shapes
     (N*M)xD and (N*M)x1 where M is the number of batches.
 
+    The output tensors are preallocated and each batch is written directly
+    into them. Their size is taken from the DataLoader's sampler, or, when it
+    has no length, from a first pass over the DataLoader. If the DataLoader
+    returns more samples than that, e.g. with a batch_sampler of its own,
+    they're reallocated with twice the size, so that flattening still takes
+    amortized linear time.
+
     :param dataloader: The DataLoader to flatten.
+    :param memmap_dir: Optional directory to write the output tensors to, as
+        memory-mapped .npy files named 0.npy, 1.npy, etc. This allows
+        flattening datasets larger than memory.
     :return: A tuple of one or more tensors containing the data from all
         batches.
     """
 
-    out_tensors_cache = []
+    try:
+        n_samples = len(dataloader.sampler)
+    except TypeError:
+        # Iterable datasets have no sampler length, so count them first
+        n_samples = sum(_batch_tensors(batch)[0].shape[0]
+                        for batch in dataloader)
 
+    out_tensors = None
+    n = 0
     for batch in dataloader:
+        batch = _batch_tensors(batch)
+        batch_size = batch[0].shape[0]
+        if out_tensors is None:
+            out_tensors = tuple(
+                _empty((n_samples, *tensor.shape[1:]), tensor.dtype,
+                       memmap_dir, i)
+                for i, tensor in enumerate(batch)
+            )
+        if n + batch_size > n_samples:
+            n_samples = max(2 * n_samples, n + batch_size)
+            out_tensors = tuple(_grow(out, n, n_samples, memmap_dir, i)
+                                for i, out in enumerate(out_tensors))
+
+        for out, tensor in zip(out_tensors, batch):
+            # 0 is batch dimension
+            out[n:n + batch_size] = tensor
+        n += batch_size
+
+    if out_tensors is None:
+        return ()
+    # Fewer samples than were allocated are returned when the last batch is
+    # dropped, or after the outputs grew.
+    if memmap_dir is not None and n < n_samples:
+        return tuple(_truncate(out, n, memmap_dir, i)
+                     for i, out in enumerate(out_tensors))
+    return tuple(out[:n] for out in out_tensors)
+
+
+def _batch_tensors(batch):
+    # Handle case of batch being a tensor (no labels)
+    if torch.is_tensor(batch):
+        return (batch,)
+    # Handle case of batch being a dict
+    elif isinstance(batch, dict):
+        return tuple(batch[k] for k in sorted(batch.keys()))
+    elif not isinstance(batch, tuple) and not isinstance(batch, list):
+        raise TypeError("Unexpected type of batch object")
+    return batch
+
 
-        # Handle case of batch being a tensor (no labels)
-        if torch.is_tensor(batch):
-            batch = (batch,)
-        # Handle case of batch being a dict
-        elif isinstance(batch, dict):
-            batch = tuple(batch[k] for k in sorted(batch.keys()))
-        elif not isinstance(batch, tuple) and not isinstance(batch, list):
-            raise TypeError("Unexpected type of batch object")
+def _empty(shape, dtype, memmap_dir, i, suffix=''):
+    if memmap_dir is None:
+        return torch.empty(shape, dtype=dtype)
 
-        for i, tensor in enumerate(batch):
-            if i >= len(out_tensors_cache):
-                out_tensors_cache.append([])
+    os.makedirs(memmap_dir, exist_ok=True)
+    np_dtype = torch.empty(0, dtype=dtype).numpy().dtype
+    array = np.lib.format.open_memmap(
+        os.path.join(memmap_dir, f'{i}.npy{suffix}'), mode='w+',
+        dtype=np_dtype, shape=shape)
+    return torch.from_numpy(array)
 
-            out_tensors_cache[i].append(tensor)
 
-    out_tensors = tuple(
-        # 0 is batch dimension
-        torch.cat(tensors_list, dim=0) for tensors_list in out_tensors_cache
-    )
+def _grow(out, n_used, n_samples, memmap_dir, i):
+    """
+    Reallocates an output tensor with room for n_samples, keeping its first
+    n_used rows. A memory-mapped output is copied to a new file which then
+    replaces the old one.
+    """
+    grown = _empty((n_samples, *out.shape[1:]), out.dtype, memmap_dir, i,
+                   suffix='.tmp')
+    grown[:n_used] = out[:n_used]
+    if memmap_dir is not None:
+        path = os.path.join(memmap_dir, f'{i}.npy')
+        os.replace(f'{path}.tmp', path)
+    return grown
+
+
+def _truncate(out, n, memmap_dir, i):
+    """
+    Truncates a memory-mapped output to its first n rows in place, by
+    rewriting the shape in the .npy header, padded to its previous length,
+    and cutting the file after the n-th row.
+    :return: The truncated output, mapped again.
+    """
+    path = os.path.join(memmap_dir, f'{i}.npy')
+    row_bytes = out[:1].numel() * out.element_size()
+    del out
+    with open(path, 'r+b') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = \
+                np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+        # The magic string, version and header length field
+        prefix_len = 10 if version == (1, 0) else 12
 
-    return out_tensors
+        header = repr(dict(descr=np.lib.format.dtype_to_descr(dtype),
+                           fortran_order=fortran_order,
+                           shape=(n, *shape[1:])))
+        header = header.ljust(data_offset - prefix_len - 1) + '\n'
+        f.seek(prefix_len)
+        f.write(header.encode('latin1'))
+        f.truncate(data_offset + n * row_bytes)
+    return torch.from_numpy(np.load(path, mmap_mode='r+'))
@@ -1,7 +1,11 @@
+import os
+
+import numpy as np
 import pytest
 
 import torch
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset
+from torch.utils.data import BatchSampler, RandomSampler
 import cs236781.dataloader_utils as dl_utils
 
 
@@ -41,6 +45,76 @@ class TestFlatten(object):
         assert x.shape == y.shape
         assert z.shape == torch.Size([DATASET_SIZE, DATA_SIZE, 1])
 
+    def test_values(self):
+        loader = DataLoader(TensorTwoTupleDataset(), batch_size=300)
+
+        x, y = dl_utils.flatten(loader)
+
+        assert torch.equal(y[:, 0, 0], torch.arange(DATASET_SIZE).float())
+        assert torch.equal(x[:, 0, 0], y[:, 0, 0])
+
+    def test_drop_last(self):
+        loader = DataLoader(TensorDataset(), batch_size=300, drop_last=True)
+
+        x, = dl_utils.flatten(loader)
+
+        assert x.shape == torch.Size([900, DATA_SIZE, DATA_SIZE])
+
+    def test_iterable(self):
+        loader = DataLoader(TensorIterableDataset(), batch_size=256)
+
+        x, = dl_utils.flatten(loader)
+
+        assert x.shape == torch.Size([DATASET_SIZE, DATA_SIZE, DATA_SIZE])
+        assert torch.equal(x[:, 0, 0], torch.arange(DATASET_SIZE).float())
+
+    def test_batch_sampler(self):
+        # The batch sampler returns more samples than the dataset holds
+        sampler = RandomSampler(range(DATASET_SIZE), replacement=True,
+                                num_samples=DATASET_SIZE + 500)
+        loader = DataLoader(TensorTwoTupleDataset(),
+                            batch_sampler=BatchSampler(sampler, 256, False))
+
+        x, y = dl_utils.flatten(loader)
+
+        assert x.shape == torch.Size([DATASET_SIZE + 500, DATA_SIZE,
+                                      DATA_SIZE])
+        assert torch.equal(x[:, 0, 0], y[:, 0, 0])
+
+    def test_memmap(self, tmpdir):
+        loader = DataLoader(TensorTwoTupleDataset(), batch_size=256)
+
+        x, y = dl_utils.flatten(loader, memmap_dir=str(tmpdir))
+
+        assert x.shape == torch.Size([DATASET_SIZE, DATA_SIZE, DATA_SIZE])
+        assert y.shape == torch.Size([DATASET_SIZE, DATA_SIZE, 1])
+        x_file = np.load(os.path.join(str(tmpdir), '0.npy'), mmap_mode='r')
+        assert np.array_equal(x_file, x.numpy())
+
+    def test_memmap_drop_last(self, tmpdir):
+        loader = DataLoader(TensorTwoTupleDataset(), batch_size=300,
+                            drop_last=True)
+
+        x, y = dl_utils.flatten(loader, memmap_dir=str(tmpdir))
+
+        assert x.shape == torch.Size([900, DATA_SIZE, DATA_SIZE])
+        for i, tensor in enumerate((x, y)):
+            tensor_file = np.load(os.path.join(str(tmpdir), f'{i}.npy'))
+            assert np.array_equal(tensor_file, tensor.numpy())
+
+    def test_memmap_batch_sampler(self, tmpdir):
+        sampler = RandomSampler(range(DATASET_SIZE), replacement=True,
+                                num_samples=DATASET_SIZE + 500)
+        loader = DataLoader(TensorTwoTupleDataset(),
+                            batch_sampler=BatchSampler(sampler, 256, False))
+
+        x, y = dl_utils.flatten(loader, memmap_dir=str(tmpdir))
+
+        assert x.shape[0] == DATASET_SIZE + 500
+        for i, tensor in enumerate((x, y)):
+            tensor_file = np.load(os.path.join(str(tmpdir), f'{i}.npy'))
+            assert np.array_equal(tensor_file, tensor.numpy())
+
 
 class TensorDataset(Dataset):
     def __len__(self):
@@ -50,6 +124,12 @@ class TensorDataset(Dataset):
         return index * torch.ones(DATA_SIZE, DATA_SIZE)
 
 
+class TensorIterableDataset(IterableDataset):
+    def __iter__(self):
+        return (index * torch.ones(DATA_SIZE, DATA_SIZE)
+                for index in range(DATASET_SIZE))
+
+
 class TensorTwoTupleDataset(Dataset):
     def __len__(self):
         return DATASET_SIZE
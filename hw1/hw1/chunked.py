@@ -0,0 +1,174 @@
+import bisect
+
+import torch
+from torch import Tensor
+
+from .quantization import QuantizedTensor
+
+# Default number of rows of the chunks small appends are copied into.
+DEFAULT_CHUNK_ROWS = 4096
+
+
+class ChunkedTensor(object):
+    """
+    An append-only matrix of samples stored as a list of chunks, so that
+    appending never copies the samples already stored.
+    Batches of at least chunk_rows samples are kept as chunks of their own,
+    while smaller ones are copied into preallocated chunks of chunk_rows.
+    Slicing rows returns a view when they're within a single chunk and a
+    copy otherwise, so it can be used in place of a tensor by code which
+    reads blocks of rows, such as distances.l2_topk.
+    """
+
+    def __init__(self, x=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+        """
+        :param x: Optional initial samples, a tensor of shape (N, D) or a
+            QuantizedTensor. They're stored without copying.
+        :param chunk_rows: Number of rows of the chunks small appends are
+            copied into.
+        """
+        self.chunk_rows = chunk_rows
+        self.chunks = []
+        self.offsets = [0]
+        self._tail = None
+        self._tail_used = 0
+        if x is not None:
+            self._add_chunk(x)
+
+    def append(self, x):
+        """
+        Appends samples after the existing ones.
+        :param x: Tensor of shape (M, D), or a QuantizedTensor, with the same
+            type of storage as the existing samples.
+        """
+        if not torch.is_tensor(x) or x.shape[0] >= self.chunk_rows:
+            self._tail = None
+            self._add_chunk(x)
+            return
+
+        start = 0
+        while start < x.shape[0]:
+            if self._tail is None or self._tail_used == self._tail.shape[0]:
+                self._tail = x.new_empty((self.chunk_rows, *x.shape[1:]))
+                self._tail_used = 0
+                self._add_chunk(self._tail[:0])
+
+            n = min(x.shape[0] - start, self._tail.shape[0] - self._tail_used)
+            end = self._tail_used + n
+            self._tail[self._tail_used:end] = x[start:start + n]
+            self._tail_used = end
+            self.chunks[-1] = self._tail[:end]
+            self.offsets[-1] += n
+            start += n
+
+    @property
+    def shape(self):
+        return torch.Size((self.offsets[-1], *self.chunks[0].shape[1:]))
+
+    @property
+    def dtype(self):
+        return self.chunks[0].dtype
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def __getitem__(self, index):
+        if isinstance(index, int):
+            index %= len(self)
+            return self[index:index + 1][0]
+        if isinstance(index, slice):
+            return self._get_slice(index)
+        return self.index_select(0, torch.as_tensor(index))[:]
+
+    def index_select(self, dim, index: Tensor):
+        """
+        Gathers rows from all chunks, keeping their type of storage.
+        :param dim: Must be 0.
+        :param index: Indices of the rows to select.
+        :return: A tensor, or a QuantizedTensor if the chunks are quantized,
+            with the selected rows.
+        """
+        assert dim == 0, "Only rows can be selected"
+        index = torch.where(index < 0, index + len(self), index)
+        order = torch.argsort(index)
+        sorted_index = index[order]
+
+        bounds = torch.searchsorted(sorted_index,
+                                    torch.tensor(self.offsets)).tolist()
+        selected = [
+            self.chunks[c].index_select(
+                0, sorted_index[start:end] - self.offsets[c])
+            for c, (start, end) in enumerate(zip(bounds[:-1], bounds[1:]))
+        ]
+        if torch.is_tensor(selected[0]):
+            out = torch.cat(selected, dim=0)
+        else:
+            out = QuantizedTensor.cat(selected)
+
+        # Restore the requested order of the rows
+        inverse = torch.empty_like(order)
+        inverse[order] = torch.arange(len(order))
+        return out.index_select(0, inverse)
+
+    def head(self, n):
+        """
+        Returns the first n rows without copying them. This is safe while
+        rows are appended concurrently, since stored rows never change.
+        :param n: Number of rows, at most len(self).
+        :return: A ChunkedTensor of the first n rows, sharing their chunks.
+            Rows appended to either one later aren't seen by the other.
+        """
+        # The offsets are read first: append() replaces a chunk before it
+        # updates its offset, so the chunks read next hold at least as many
+        # rows as the offsets say.
+        offsets = list(self.offsets)
+        chunks = list(self.chunks)
+        last = max(1, bisect.bisect_left(offsets, n))
+        out = ChunkedTensor(chunk_rows=self.chunk_rows)
+        out.chunks = chunks[:last]
+        out.chunks[-1] = out.chunks[-1][:n - offsets[last - 1]]
+        out.offsets = offsets[:last] + [n]
+        return out
+
+    def _get_slice(self, index: slice):
+        start, stop, step = index.indices(len(self))
+        assert step == 1, "Only contiguous slices are supported"
+        if stop <= start:
+            return self.chunks[0][0:0]
+
+        first = bisect.bisect_right(self.offsets, start) - 1
+        last = bisect.bisect_left(self.offsets, stop) - 1
+        if first == last:
+            offset = self.offsets[first]
+            return self.chunks[first][start - offset:stop - offset]
+
+        pieces = []
+        for c in range(first, last + 1):
+            offset = self.offsets[c]
+            pieces.append(self.chunks[c][max(start - offset, 0):
+                                         stop - offset])
+        return torch.cat(pieces, dim=0)
+
+    def _add_chunk(self, x):
+        self.chunks.append(x)
+        self.offsets.append(self.offsets[-1] + x.shape[0])
+
+
+def append_rows(buf: Tensor, n_used, x: Tensor):
+    """
+    Writes rows after the first n_used rows of a buffer. When the buffer is
+    full it's reallocated with twice the capacity, so that appending takes
+    amortized O(len(x)).
+    :param buf: The buffer, a tensor with at least n_used rows.
+    :param n_used: Number of rows of buf in use.
+    :param x: Tensor with the rows to append.
+    :return: The buffer holding all n_used + len(x) rows, which may be a new
+        tensor.
+    """
+    n = n_used + x.shape[0]
+    if n > buf.shape[0]:
+        out = buf.new_empty((max(2 * buf.shape[0], n), *buf.shape[1:]))
+        out[:n_used] = buf[:n_used]
+        buf = out
+    buf[n_used:n] = x
+    return buf
@@ -1,21 +1,132 @@
+import itertools
 import math
+import os
+import time
 
 import numpy as np
 import torch
 import torch.utils.data.sampler as sampler
 from torch.utils.data import Dataset
+from torch.utils.data.dataloader import default_collate
+
+import cs236781.dataloader_utils as dataloader_utils
+from .dataset_cache import dataset_fingerprint, int_label
+from .datasets import StackedSamples
+
+# Batch sizes tried by the 'auto' mode of create_train_validation_loaders.
+AUTO_BATCH_SIZES = (32, 64, 128, 256, 512)
+
+# Number of batches timed per setting when tuning a loader.
+AUTO_TUNE_BATCHES = 10
+
+# Default seed of the train/validation split.
+DEFAULT_SPLIT_SEED = 42
+
+# Number of samples fetched at a time when collecting a dataset's labels.
+LABELS_BATCH_SIZE = 1024
+
+# Splits computed in this process, by (fingerprint, validation_ratio, seed).
+_splits = {}
+
+
+def collate_stacked(batch):
+    """
+    A DataLoader collate_fn which passes batches that a dataset's
+    __getitems__() already stacked through as they are, and collates other
+    batches with the default collate_fn.
+    :param batch: A datasets.StackedSamples, or a list of samples.
+    :return: A tuple (samples, labels) of tensors.
+    """
+    if isinstance(batch, StackedSamples):
+        return batch.samples, batch.labels
+    return default_collate(batch)
+
+
+class InMemoryLoader(object):
+    """
+    Iterates over minibatches of samples which are already in memory, as a
+    light replacement of a DataLoader whose data fits in memory.
+    Each epoch the samples are shuffled with a single permutation into a
+    reused buffer, and minibatches are views of that buffer.
+    """
+
+    def __init__(self, x: torch.Tensor, y: torch.Tensor, batch_size,
+                 shuffle=True, drop_last=False):
+        """
+        :param x: Tensor of shape (N, ...) with the samples.
+        :param y: Tensor of shape (N,) with their labels.
+        :param batch_size: Number of samples per minibatch.
+        :param shuffle: Whether to shuffle the samples every epoch. The
+            minibatches of an epoch are then overwritten by the next one.
+        :param drop_last: Whether to drop the last minibatch if it's smaller
+            than batch_size.
+        """
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self._x_buf = None
+        self._y_buf = None
+
+    @classmethod
+    def from_loader(cls, dl: torch.utils.data.DataLoader, shuffle=True):
+        """
+        Loads all samples of a DataLoader into memory once.
+        :param dl: A DataLoader returning (x, y) batches.
+        :param shuffle: Whether to shuffle the samples every epoch.
+        :return: An InMemoryLoader with the same batch size.
+        """
+        x, y = dataloader_utils.flatten(dl)
+        return cls(x, y, dl.batch_size, shuffle=shuffle,
+                   drop_last=dl.drop_last)
+
+    def __iter__(self):
+        x, y = self.x, self.y
+        if self.shuffle:
+            if self._x_buf is None:
+                self._x_buf, self._y_buf = torch.empty_like(x), \
+                    torch.empty_like(y)
+            perm = torch.randperm(len(y))
+            x = torch.index_select(x, 0, perm, out=self._x_buf)
+            y = torch.index_select(y, 0, perm, out=self._y_buf)
+
+        n = len(self) * self.batch_size if self.drop_last else len(y)
+        for i in range(0, n, self.batch_size):
+            yield x[i:i + self.batch_size], y[i:i + self.batch_size]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.y) // self.batch_size
+        return math.ceil(len(self.y) / self.batch_size)
 
 
 def create_train_validation_loaders(dataset: Dataset, validation_ratio,
-                                    batch_size=100, num_workers=2):
+                                    batch_size=100, num_workers=2,
+                                    pin_memory=None, persistent_workers=False,
+                                    prefetch_factor=2,
+                                    seed=DEFAULT_SPLIT_SEED,
+                                    split_cache_dir=None):
     """
     Splits a dataset into a train and validation set, returning a
     DataLoader for each.
     :param dataset: The dataset to split.
     :param validation_ratio: Ratio (in range 0,1) of the validation set size to
         total dataset size.
-    :param batch_size: Batch size the loaders will return from each set.
-    :param num_workers: Number of workers to pass to dataloader init.
+    :param batch_size: Batch size the loaders will return from each set, or
+        'auto' to choose the fastest of AUTO_BATCH_SIZES with tune_loader().
+    :param num_workers: Number of workers to pass to dataloader init, or
+        'auto' to choose the fastest of auto_worker_counts() with
+        tune_loader().
+    :param pin_memory: Whether the loaders return batches in pinned memory,
+        for faster copies to the GPU. Defaults to whether CUDA is available.
+    :param persistent_workers: Whether to keep the worker processes alive
+        between epochs instead of restarting them. Ignored without workers.
+    :param prefetch_factor: Number of batches each worker loads in advance.
+        Ignored without workers.
+    :param seed: Seed of the split, see train_validation_split().
+    :param split_cache_dir: Optional directory to cache the split in, see
+        train_validation_split().
     :return: A tuple of train and validation DataLoader instances.
     """
     if not(0.0 < validation_ratio < 1.0):
@@ -32,19 +143,229 @@ def create_train_validation_loaders(dataset: Dataset, validation_ratio,
     #  you create.
     # ====== YOUR CODE: ======
     # Split training into train and validation
-    indices = torch.randperm(len(dataset))
-    valid_size = int(validation_ratio*len(dataset)//1)
-    train_size = int((1-validation_ratio)*len(dataset)//1)
-    
-    train_indices = indices[:len(indices)-valid_size][:train_size or None]
-    valid_indices = indices[len(indices)-valid_size:] if valid_size else None 
-   
-    dl_train = torch.utils.data.DataLoader(dataset, pin_memory=True, batch_size=batch_size,
-                                               sampler=sampler.SubsetRandomSampler(train_indices))    
-    
-    dl_valid = torch.utils.data.DataLoader(dataset, pin_memory=True, batch_size=batch_size,
-                                                   sampler=sampler.SubsetRandomSampler(valid_indices))
+    train_indices, valid_indices = train_validation_split(
+        dataset, validation_ratio, seed=seed, cache_dir=split_cache_dir)
+
+    if pin_memory is None:
+        pin_memory = torch.cuda.is_available()
+    if batch_size == 'auto' or num_workers == 'auto':
+        batch_size, num_workers = tune_loader(
+            dataset, train_indices,
+            AUTO_BATCH_SIZES if batch_size == 'auto' else (batch_size,),
+            auto_worker_counts() if num_workers == 'auto' else
+            (num_workers,),
+            pin_memory=pin_memory)
+
+    dl_train, dl_valid = [
+        create_loader(dataset, split_indices, batch_size, num_workers,
+                      pin_memory=pin_memory,
+                      persistent_workers=persistent_workers,
+                      prefetch_factor=prefetch_factor)
+        for split_indices in (train_indices, valid_indices)
+    ]
     # ========================
 
     return dl_train, dl_valid
 
+
+def create_loader(dataset: Dataset, indices, batch_size, num_workers,
+                  pin_memory=False, persistent_workers=False,
+                  prefetch_factor=2):
+    """
+    Creates a DataLoader which returns the given samples of a dataset in
+    random order.
+    :param dataset: The dataset to load.
+    :param indices: Indices of the samples to load.
+    :param batch_size: Batch size the loader will return.
+    :param num_workers: Number of worker processes, or 0 to load in the
+        calling process.
+    :param pin_memory: Whether to return batches in pinned memory.
+    :param persistent_workers: Whether to keep the worker processes alive
+        between epochs. Ignored without workers.
+    :param prefetch_factor: Number of batches each worker loads in advance.
+        Ignored without workers.
+    :return: A DataLoader.
+    """
+    # These options are rejected by DataLoader when there are no workers
+    worker_kw = {}
+    if num_workers > 0:
+        worker_kw = dict(persistent_workers=persistent_workers,
+                         prefetch_factor=prefetch_factor)
+    return torch.utils.data.DataLoader(
+        dataset, batch_size=batch_size, num_workers=num_workers,
+        pin_memory=pin_memory, sampler=sampler.SubsetRandomSampler(indices),
+        collate_fn=collate_stacked, **worker_kw)
+
+
+def auto_worker_counts():
+    """
+    :return: The numbers of workers tried by the 'auto' mode of
+        create_train_validation_loaders: no workers, and powers of two up to
+        the number of CPUs.
+    """
+    n_cpus = os.cpu_count() or 1
+    return (0,) + tuple(2 ** i for i in range(int(math.log2(n_cpus)) + 1))
+
+
+def tune_loader(dataset: Dataset, indices, batch_sizes, worker_counts,
+                n_batches=AUTO_TUNE_BATCHES, pin_memory=False):
+    """
+    Measures the throughput of loading a dataset with different batch sizes
+    and numbers of workers, on a few batches of each.
+    :param dataset: The dataset to load.
+    :param indices: Indices of the samples to load from.
+    :param batch_sizes: Batch sizes to try.
+    :param worker_counts: Numbers of workers to try.
+    :param n_batches: Number of batches timed per setting, after a first
+        batch which isn't timed since it includes starting the workers.
+    :param pin_memory: Whether the loaders return batches in pinned memory.
+    :return: A tuple (batch_size, num_workers) of the setting which loaded
+        the most samples per second.
+    """
+    settings = list(itertools.product(batch_sizes, worker_counts))
+    if len(settings) == 1:
+        return settings[0]
+
+    best, best_rate = None, -1.
+    for batch_size, num_workers in settings:
+        dl = create_loader(dataset, indices, batch_size, num_workers,
+                           pin_memory=pin_memory)
+        it = iter(dl)
+        next(it, None)
+        n_samples = 0
+        start = time.perf_counter()
+        for x, _ in itertools.islice(it, n_batches):
+            n_samples += len(x)
+        rate = n_samples / (time.perf_counter() - start)
+        del it
+
+        if rate > best_rate:
+            best, best_rate = (batch_size, num_workers), rate
+    return best
+
+
+def train_validation_split(dataset: Dataset, validation_ratio,
+                           seed=DEFAULT_SPLIT_SEED, cache_dir=None):
+    """
+    Splits the indices of a dataset into a train and validation set,
+    stratified by label: each class is split by the validation ratio, up to
+    rounding, and the validation set has exactly
+    int(validation_ratio * len(dataset)) samples.
+    Datasets without integer labels, e.g. unlabeled ones or ones with float
+    targets, are split by a seeded random permutation instead.
+    The split depends only on the dataset's content, the ratio and the seed,
+    so it's computed once per process and, given a cache_dir, once per
+    machine.
+    :param dataset: A dataset, usually of (sample, label) tuples.
+    :param validation_ratio: Ratio (in range 0,1) of the validation set size
+        to total dataset size.
+    :param seed: Seed of the random choice of samples.
+    :param cache_dir: Optional directory where splits are saved as int32
+        .npy files, named by the dataset's fingerprint, ratio and seed.
+    :return: A tuple (train_indices, valid_indices) of sorted int64 tensors.
+    """
+    fingerprint = dataset_fingerprint(dataset)
+    key = (fingerprint, validation_ratio, seed)
+    if key in _splits:
+        return _splits[key]
+
+    path = None
+    if cache_dir is not None:
+        path = os.path.join(cache_dir, f'split_{fingerprint}_'
+                                       f'{validation_ratio}_{seed}.npy')
+    if path is not None and os.path.isfile(path):
+        split = np.load(path)
+        n_valid = int(validation_ratio * len(dataset))
+        train_indices, valid_indices = split[n_valid:], split[:n_valid]
+    else:
+        labels = dataset_labels(dataset)
+        if labels is not None:
+            train_indices, valid_indices = _stratified_split(
+                labels, validation_ratio, seed)
+        else:
+            train_indices, valid_indices = _random_split(
+                len(dataset), validation_ratio, seed)
+        if path is not None:
+            # Both sets in a single file, the validation set first
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f'{path}.tmp{os.getpid()}.npy'
+            np.save(tmp_path, np.concatenate((valid_indices, train_indices))
+                    .astype(np.int32))
+            os.replace(tmp_path, path)
+
+    split = (torch.from_numpy(train_indices.astype(np.int64)),
+             torch.from_numpy(valid_indices.astype(np.int64)))
+    _splits[key] = split
+    return split
+
+
+def dataset_labels(dataset: Dataset):
+    """
+    Collects the labels of all samples of a dataset. They're taken from its
+    targets attribute if it has one, as torchvision datasets and subsets of
+    them do, and otherwise fetched from the dataset, which decodes every
+    sample.
+    :param dataset: A dataset of (sample, label) tuples.
+    :return: A numpy array of shape (N,) with the labels, or None if the
+        dataset's items aren't (sample, label) tuples with integer labels.
+    """
+    targets = getattr(dataset, 'targets', None)
+    if targets is not None and len(targets) == len(dataset):
+        targets = np.asarray(targets)
+        if targets.ndim != 1 or \
+                not np.issubdtype(targets.dtype, np.integer):
+            return None
+        return targets.astype(np.int64)
+
+    labels = np.empty(len(dataset), dtype=np.int64)
+    for start in range(0, len(dataset), LABELS_BATCH_SIZE):
+        indices = list(range(start, min(start + LABELS_BATCH_SIZE,
+                                        len(dataset))))
+        if hasattr(dataset, '__getitems__'):
+            batch = dataset.__getitems__(indices)
+        else:
+            batch = [dataset[i] for i in indices]
+        if isinstance(batch, StackedSamples):
+            if batch.labels.is_floating_point():
+                return None
+            labels[indices] = batch.labels.numpy()
+            continue
+        if not all(isinstance(item, (tuple, list)) and len(item) == 2
+                   for item in batch):
+            return None
+        batch_labels = [int_label(y) for _, y in batch]
+        if None in batch_labels:
+            return None
+        labels[indices] = batch_labels
+    return labels
+
+
+def _random_split(n, validation_ratio, seed):
+    n_valid = int(validation_ratio * n)
+    perm = np.random.default_rng(seed).permutation(n)
+    return np.sort(perm[n_valid:]), np.sort(perm[:n_valid])
+
+
+def _stratified_split(labels: np.ndarray, validation_ratio, seed):
+    n = len(labels)
+    n_valid = int(validation_ratio * n)
+    classes, labels, counts = np.unique(labels, return_inverse=True,
+                                        return_counts=True)
+
+    # Each class gets its share of the validation set rounded down, and the
+    # samples left are given to the classes with the largest remainders.
+    shares = validation_ratio * counts
+    quotas = np.floor(shares).astype(np.int64)
+    remainder_order = np.argsort(-(shares - quotas), kind='stable')
+    quotas[remainder_order[:n_valid - quotas.sum()]] += 1
+
+    # Group the samples by class in random order, and take the first ones
+    # of each class for validation.
+    rng = np.random.default_rng(seed)
+    perm = rng.permutation(n)
+    order = perm[np.argsort(labels[perm], kind='stable')]
+    class_starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rank = np.arange(n) - class_starts[labels[order]]
+    is_valid = rank < quotas[labels[order]]
+
+    return np.sort(order[~is_valid]), np.sort(order[is_valid])
@@ -0,0 +1,212 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from .datasets import StackedSamples
+
+# Number of samples per cache shard.
+DEFAULT_SHARD_SIZE = 8192
+
+# Number of samples hashed by dataset_fingerprint().
+DEFAULT_FINGERPRINT_SAMPLES = 16
+
+# Version of the cache layout, part of every fingerprint so that caches
+# written in an older layout are never read.
+CACHE_VERSION = 2
+
+
+def dataset_fingerprint(dataset: Dataset,
+                        n_samples=DEFAULT_FINGERPRINT_SAMPLES):
+    """
+    Calculates a hash of a dataset's content, from its type, its length and
+    the content of some samples spread evenly over it. Hashing only some of
+    the samples keeps this cheap for large datasets, at the cost of missing
+    changes to the other ones.
+    :param dataset: A dataset of (sample, label) tuples, or of any items
+        made of tensors, arrays and scalars, e.g. unlabeled samples.
+    :param n_samples: Number of samples to hash.
+    :return: A hex string.
+    """
+    n = len(dataset)
+    h = hashlib.sha1()
+    h.update(f'{CACHE_VERSION}:{type(dataset).__qualname__}:{n}'.encode())
+    for i in np.unique(np.linspace(0, n - 1, min(n, n_samples), dtype=int)):
+        item = dataset[int(i)]
+        if not isinstance(item, (tuple, list)):
+            item = (item,)
+        h.update(f'{i}:{len(item)}'.encode())
+        for value in item:
+            if torch.is_tensor(value) or isinstance(value, np.ndarray):
+                value = torch.as_tensor(value).numpy()
+                h.update(f':{value.dtype}:{value.shape}:'.encode())
+                h.update(np.ascontiguousarray(value).tobytes())
+            else:
+                h.update(f':{value!r}'.encode())
+    return h.hexdigest()[:16]
+
+
+class CachedDataset(Dataset):
+    """
+    A dataset which materializes another dataset once into .npy shards on
+    disk, and then serves its samples from memory-mapped shards.
+    Samples are returned as views of the mapped shards, so after the first
+    pass they cost no decoding and pages are shared by all processes
+    reading the same cache, e.g. DataLoader workers. The mapping is
+    copy-on-write: writing to a sample doesn't reach the files or other
+    processes.
+    All samples must be tensors (or arrays) of the same shape and dtype, with
+    integer labels; other datasets raise a ValueError.
+    """
+
+    def __init__(self, dataset: Dataset, cache_dir, fingerprint=None,
+                 shard_size=DEFAULT_SHARD_SIZE):
+        """
+        :param dataset: The dataset to cache.
+        :param cache_dir: Directory of the caches. Each dataset is cached in
+            a sub-directory named by its fingerprint, so a dataset whose
+            content changed gets a new cache.
+        :param fingerprint: Optional identifier of the dataset's content.
+            Defaults to dataset_fingerprint(dataset).
+        :param shard_size: Number of samples per shard file.
+        """
+        self.fingerprint = fingerprint or dataset_fingerprint(dataset)
+        self.path = os.path.join(cache_dir, self.fingerprint)
+        if not os.path.isfile(os.path.join(self.path, 'meta.json')):
+            _write_cache(dataset, self.path, shard_size)
+
+        with open(os.path.join(self.path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.num_samples = meta['num_samples']
+        self.shard_size = meta['shard_size']
+        self.n_shards = meta['n_shards']
+        self._shards = None
+        self._labels = None
+
+    def __getitem__(self, index):
+        if not -self.num_samples <= index < self.num_samples:
+            raise IndexError("out of bounds")
+        self._open()
+        shard, row = divmod(index % self.num_samples, self.shard_size)
+        return torch.from_numpy(self._shards[shard][row]), \
+            int(self._labels[index])
+
+    def __getitems__(self, indices):
+        """
+        Returns a batch of samples, gathering the rows of each shard at once.
+        :param indices: Sequence of B sample indices.
+        :return: A StackedSamples of the samples and their labels.
+        """
+        indices = torch.as_tensor(indices, dtype=torch.int64)
+        if ((indices < -self.num_samples) |
+                (indices >= self.num_samples)).any():
+            raise IndexError("out of bounds")
+        self._open()
+
+        indices = (indices % self.num_samples).numpy()
+        shard_idx, rows = np.divmod(indices, self.shard_size)
+        samples = torch.empty((len(indices), *self._shards[0].shape[1:]),
+                              dtype=torch.from_numpy(self._shards[0][:0])
+                              .dtype)
+        for shard in np.unique(shard_idx):
+            mask = shard_idx == shard
+            samples[torch.from_numpy(mask)] = torch.from_numpy(
+                self._shards[shard][rows[mask]])
+        return StackedSamples(samples,
+                              torch.from_numpy(self._labels[indices]))
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getstate__(self):
+        # Mapped shards would be pickled as copies, so worker processes
+        # which unpickle the dataset map them again instead.
+        state = self.__dict__.copy()
+        state['_shards'] = None
+        state['_labels'] = None
+        return state
+
+    def _open(self):
+        if self._shards is not None:
+            return
+        self._labels = np.load(os.path.join(self.path, 'labels.npy'),
+                               mmap_mode='c')
+        self._shards = [
+            np.load(os.path.join(self.path, f'shard_{i}.npy'), mmap_mode='c')
+            for i in range(self.n_shards)
+        ]
+
+
+def _write_cache(dataset: Dataset, path, shard_size):
+    """
+    Writes all samples of a dataset to .npy shards in a directory. The
+    shards are written to a temporary directory which is then renamed, so
+    that readers never see a partial cache.
+    """
+    n = len(dataset)
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    os.makedirs(tmp_path, exist_ok=True)
+
+    labels = np.lib.format.open_memmap(os.path.join(tmp_path, 'labels.npy'),
+                                       mode='w+', dtype=np.int64, shape=(n,))
+    n_shards = 0
+    for start in range(0, n, shard_size):
+        samples, shard_labels = _fetch(dataset,
+                                       range(start, min(start + shard_size,
+                                                        n)))
+        shard = np.lib.format.open_memmap(
+            os.path.join(tmp_path, f'shard_{n_shards}.npy'), mode='w+',
+            dtype=samples.numpy().dtype, shape=tuple(samples.shape))
+        shard[:] = samples.numpy()
+        labels[start:start + len(shard_labels)] = shard_labels.numpy()
+        shard.flush()
+        n_shards += 1
+    labels.flush()
+
+    meta = dict(num_samples=n, shard_size=shard_size, n_shards=n_shards)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another process finished writing the same cache first
+        shutil.rmtree(tmp_path)
+
+
+def _fetch(dataset: Dataset, indices):
+    """
+    Fetches samples from a dataset, using its __getitems__() if it has one.
+    :return: A tuple of tensors (samples, labels).
+    """
+    if hasattr(dataset, '__getitems__'):
+        batch = dataset.__getitems__(list(indices))
+        if isinstance(batch, StackedSamples):
+            return batch.samples, batch.labels
+    else:
+        batch = [dataset[i] for i in indices]
+    if not all(isinstance(item, (tuple, list)) and len(item) == 2
+               for item in batch):
+        raise ValueError("CachedDataset requires (sample, label) items")
+    samples = torch.stack([torch.as_tensor(x) for x, _ in batch])
+    labels = [int_label(y) for _, y in batch]
+    if None in labels:
+        raise ValueError("CachedDataset requires integer labels")
+    return samples, torch.tensor(labels, dtype=torch.int64)
+
+
+def int_label(y):
+    """
+    :param y: A label, e.g. a Python or numpy scalar or a 0-dim tensor.
+    :return: The label as an int, or None if it isn't an integer.
+    """
+    if torch.is_tensor(y) or isinstance(y, np.ndarray):
+        if y.ndim != 0 or torch.as_tensor(y).is_floating_point():
+            return None
+        return int(y)
+    if isinstance(y, (int, np.integer)) and not isinstance(y, bool):
+        return int(y)
+    return None
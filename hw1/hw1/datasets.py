@@ -1,7 +1,32 @@
-import numpy as np
+import collections.abc
 
 import torch
-from torch.utils.data import Dataset
+from torch import Tensor
+from torch.utils.data import Dataset, TensorDataset
+
+
+class StackedSamples(collections.abc.Sequence):
+    """
+    A batch of labeled samples which are already stacked into tensors, as
+    returned by the __getitems__() of the datasets in this module.
+    It's also a sequence of (sample, label) tuples, so that DataLoader's
+    default collate_fn can still handle it, while
+    dataloaders.collate_stacked returns the stacked tensors as they are.
+    """
+
+    def __init__(self, samples: Tensor, labels: Tensor):
+        """
+        :param samples: Tensor of shape (B, ...) with the samples.
+        :param labels: Tensor of shape (B,) with their labels.
+        """
+        self.samples = samples
+        self.labels = labels
+
+    def __getitem__(self, index):
+        return self.samples[index], self.labels[index]
+
+    def __len__(self):
+        return self.samples.shape[0]
 
 
 class RandomImageDataset(Dataset):
@@ -9,24 +34,22 @@ class RandomImageDataset(Dataset):
     A dataset returning random noise images of specified dimensions
     """
 
-    def __init__(self, num_samples, num_classes, C, W, H):
+    def __init__(self, num_samples, num_classes, C, W, H, seed=14):
         """
         :param num_samples: Number of samples (labeled images in the dataset)
         :param num_classes: Number of classes (labels)
         :param C: Number of channels per image
         :param W: Image width
         :param H: Image height
+        :param seed: Seed which, together with the index, determines each
+            sample.
         """
         super().__init__()
         self.num_classes = num_classes
         self.num_samples = num_samples
         self.image_dim = (C, W, H)
-        
-        #np.random.seed(14)
-        #self.data_set = np.random.uniform(0,255,size=(num_samples,C, W, H))//1        
-        #self.labels = np.random.randint(0,num_classes,num_samples)
-        
-        
+        self.seed = seed
+
     def __getitem__(self, index):
         """
         Returns a labeled sample.
@@ -39,14 +62,43 @@ class RandomImageDataset(Dataset):
         #  Try to make sure to always return the same image for the
         #  same index (make it deterministic per index), but don't mess-up
         #  the random state outside this method.
-        
+
         # ====== YOUR CODE: ======
-        
-        np.random.seed(14)
-        data_set = np.random.uniform(0,255,size=(self.num_samples,self.image_dim[0],self.image_dim[1],self.image_dim[2]))//1
-        labels = np.random.randint(0,self.num_classes,self.num_samples)
-        
-        return torch.tensor(data_set[index]),labels[index]
+        if not -self.num_samples <= index < self.num_samples:
+            raise IndexError("out of bounds")
+        image = torch.empty(self.image_dim)
+        label = self._generate(index % self.num_samples, torch.Generator(),
+                               image)
+        return image, label
+        # ========================
+
+    def __getitems__(self, indices):
+        """
+        Returns a batch of labeled samples, generated directly into a single
+        tensor instead of being stacked by the DataLoader.
+        :param indices: Sequence of B sample indices.
+        :return: A StackedSamples with a tensor of shape (B, C, W, H) of the
+            samples and a tensor of shape (B,) of their labels.
+        """
+        indices = torch.as_tensor(indices, dtype=torch.int64)
+        if ((indices < -self.num_samples) |
+                (indices >= self.num_samples)).any():
+            raise IndexError("out of bounds")
+
+        images = torch.empty((len(indices), *self.image_dim))
+        labels = torch.empty(len(indices), dtype=torch.int64)
+        gen = torch.Generator()
+        for i, index in enumerate((indices % self.num_samples).tolist()):
+            labels[i] = self._generate(index, gen, images[i])
+        return StackedSamples(images, labels)
+
+    def _generate(self, index, gen: torch.Generator, out: Tensor):
+        # The generator is reseeded per sample, keyed by the index, so only
+        # the requested samples are generated and the global random state is
+        # left untouched.
+        gen.manual_seed(self.seed * self.num_samples + index)
+        torch.randint(0, 256, self.image_dim, generator=gen, out=out)
+        return int(torch.randint(0, self.num_classes, (), generator=gen))
 
     def __len__(self):
         """
@@ -64,6 +116,9 @@ class RandomImageDataset(Dataset):
 class SubsetDataset(Dataset):
     """
     A dataset that wraps another dataset, returning a subset from it.
+    A subset of a subset is folded into a single subset of the original
+    source, so nesting adds no cost per item. Subsets of a TensorDataset
+    return slices of its tensors as views, without copying.
     """
     def __init__(self, source_dataset: Dataset, subset_len, offset=0):
         """
@@ -72,9 +127,13 @@ class SubsetDataset(Dataset):
         :param subset_len: The total number of sample in the subset.
         :param offset: The offset index to start taking samples from.
         """
-        if offset + subset_len > len(source_dataset):
+        if offset < 0 or offset + subset_len > len(source_dataset):
             raise ValueError("Not enough samples in source dataset")
 
+        if isinstance(source_dataset, SubsetDataset):
+            offset += source_dataset.offset
+            source_dataset = source_dataset.source_dataset
+
         self.source_dataset = source_dataset
         self.subset_len = subset_len
         self.offset = offset
@@ -83,16 +142,71 @@ class SubsetDataset(Dataset):
         # TODO:
         #  Return the item at index + offset from the source dataset.
         #  Raise an IndexError if index is out of bounds.
-        if index + self.offset > self.subset_len:
+        if isinstance(index, slice):
+            return self._get_slice(index)
+        if not -self.subset_len <= index < self.subset_len:
             raise IndexError("out of bounds")
-            
+
         # ====== YOUR CODE: ======
-        return self.source_dataset[index + self.offset]
+        return self.source_dataset[index % self.subset_len + self.offset]
         # ========================
 
+    def __getitems__(self, indices):
+        """
+        Returns a batch of samples, offsetting all indices at once and
+        fetching them with a single call to the source's __getitems__() when
+        it has one. Consecutive indices into a TensorDataset are returned as
+        views of its tensors.
+        :param indices: Sequence of sample indices.
+        :return: A StackedSamples for a TensorDataset of samples and labels,
+            or what the source's __getitems__() returns, or otherwise a list
+            of the items of the source, e.g. (sample, label) tuples.
+        """
+        indices = torch.as_tensor(indices, dtype=torch.int64)
+        if ((indices < -self.subset_len) |
+                (indices >= self.subset_len)).any():
+            raise IndexError("out of bounds")
+
+        indices = indices % self.subset_len + self.offset
+        if isinstance(self.source_dataset, TensorDataset):
+            start = int(indices[0]) if len(indices) > 0 else 0
+            if torch.equal(indices,
+                           torch.arange(start, start + len(indices))):
+                indices = slice(start, start + len(indices))
+            tensors = self.source_dataset[indices]
+            if len(tensors) == 2:
+                return StackedSamples(*tensors)
+            return list(zip(*tensors))
+        if hasattr(self.source_dataset, '__getitems__'):
+            return self.source_dataset.__getitems__(indices)
+        return [self.source_dataset[i] for i in indices.tolist()]
+
     def __len__(self):
-        
+
         # ====== YOUR CODE: ======
         return self.subset_len
         # ========================
 
+    @property
+    def targets(self):
+        """
+        The labels of the subset's samples, sliced from the source's targets
+        as torchvision datasets have them, or from the labels tensor of a
+        TensorDataset of samples and labels. None if the source has neither,
+        in which case labels are only known by fetching the samples.
+        """
+        source = self.source_dataset
+        if isinstance(source, TensorDataset):
+            targets = source.tensors[1] if len(source.tensors) == 2 else None
+        else:
+            targets = getattr(source, 'targets', None)
+        if targets is None:
+            return None
+        return targets[self.offset:self.offset + self.subset_len]
+
+    def _get_slice(self, index: slice):
+        start, stop, step = index.indices(self.subset_len)
+        if isinstance(self.source_dataset, TensorDataset):
+            rows = slice(start + self.offset, stop + self.offset, step)
+            return tuple(t[rows] for t in self.source_dataset.tensors)
+        return [self[i] for i in range(start, stop, step)]
@@ -0,0 +1,176 @@
+import math
+
+import torch
+from torch import Tensor
+
+# Upper bound on the memory used by a single block of distances, in bytes.
+DEFAULT_TILE_BYTES = 64 * 1024 * 1024
+
+
+def l2_dist_block(x1: Tensor, x2: Tensor, x1_sq: Tensor, x2_sq: Tensor,
+                  squared=False):
+    """
+    Calculates the L2 distance matrix between x1 and x2 given their squared
+    norms, expanding (a-b)^2 = a^2 + b^2 - 2ab into a single (N1, N2)
+    buffer without allocating any other temporaries of that size.
+    :param x1: First samples matrix, a tensor of shape (N1, D).
+    :param x2: Second samples matrix, a tensor of shape (N2, D).
+    :param x1_sq: Squared norms of x1 samples, shape (N1,).
+    :param x2_sq: Squared norms of x2 samples, shape (N2,).
+    :param squared: Whether to return squared distances, skipping the sqrt.
+    :return: A distance matrix of shape (N1, N2).
+    """
+    dists = torch.addmm(x2_sq.unsqueeze(0), x1, x2.t(), alpha=-2)
+    dists.add_(x1_sq.unsqueeze(1))
+    # Cancellation may leave tiny negative values for (near) equal samples.
+    dists.clamp_(min=0)
+    if not squared:
+        dists.sqrt_()
+    return dists
+
+
+def sq_norms(x: Tensor, max_tile_bytes=DEFAULT_TILE_BYTES):
+    """
+    Calculates the squared L2 norm of each sample, a block of samples at a
+    time, so that no temporary of the size of x is allocated.
+    :param x: Samples matrix of shape (N, D). Can also be any object which
+        returns such tensors when sliced along its first dimension.
+    :param max_tile_bytes: Memory budget of a single block.
+    :return: A tensor of shape (N,) with the squared norms.
+    """
+    n, d = x.shape
+    block_rows = max(1, max_tile_bytes // (d * _element_size(x.dtype)))
+    out = torch.empty(n, dtype=x.dtype)
+    for i in range(0, n, block_rows):
+        block = x[i:i + block_rows]
+        out[i:i + block_rows] = (block * block).sum(dim=1)
+    return out
+
+
+def tile_shape(n_rows, n_cols, element_size,
+               max_tile_bytes=DEFAULT_TILE_BYTES):
+    """
+    Calculates the shape of a distance tile which fits in a memory budget.
+    :param n_rows: Number of rows in the full distance matrix.
+    :param n_cols: Number of columns in the full distance matrix.
+    :param element_size: Size of a single distance in bytes.
+    :param max_tile_bytes: Memory budget of a single tile.
+    :return: A tuple (rows, cols) of the tile shape.
+    """
+    max_elements = max(1, max_tile_bytes // element_size)
+    rows = min(n_rows, max(1, int(math.sqrt(max_elements))))
+    cols = min(n_cols, max(1, max_elements // rows))
+    rows = min(n_rows, max(1, max_elements // cols))
+    return rows, cols
+
+
+def l2_topk(x1: Tensor, x2: Tensor, k, squared=True,
+            max_tile_bytes=DEFAULT_TILE_BYTES, x1_sq: Tensor = None):
+    """
+    Finds the k nearest samples in x1 of each sample in x2, without
+    materializing the full (N1, N2) distance matrix.
+    :param x1: Reference samples matrix, a tensor of shape (N1, D), or any
+        object which returns such tensors when sliced, e.g. a
+        quantization.QuantizedTensor.
+    :param x2: Query samples matrix, a tensor of shape (N2, D), or any
+        object which returns such tensors when sliced.
+    :param k: Number of neighbors to find, at most N1.
+    :param squared: Whether to return squared distances, which is enough for
+        ranking and skips the sqrt.
+    :param max_tile_bytes: Memory budget of a single distance tile.
+    :param x1_sq: Optional precomputed squared norms of x1, shape (N1,).
+    :return: A tuple (dists, idx) of tensors of shape (N2, k), where row j
+        holds the distances and x1 indices of the neighbors of x2 sample j,
+        sorted from nearest to farthest. Ties are broken by the lower index,
+        so the neighbors don't depend on the tile shape.
+    """
+    if not 0 < k <= x1.shape[0]:
+        raise ValueError(f"Can't find {k} neighbors among {x1.shape[0]}")
+
+    n1, n2 = x1.shape[0], x2.shape[0]
+    tile_rows, tile_cols = tile_shape(n2, n1, _element_size(x1.dtype),
+                                      max_tile_bytes)
+    if x1_sq is None:
+        x1_sq = sq_norms(x1, max_tile_bytes)
+
+    out_dists = torch.empty(n2, k, dtype=x1.dtype)
+    out_idx = torch.empty(n2, k, dtype=torch.int64)
+    for i in range(0, n2, tile_rows):
+        queries = slice(i, min(i + tile_rows, n2))
+        x2_block = x2[queries]
+        x2_sq = (x2_block ** 2).sum(dim=1)
+
+        best_dists, best_idx = None, None
+        for j in range(0, n1, tile_cols):
+            refs = slice(j, min(j + tile_cols, n1))
+            # Tiles hold one query per row, so that the top-k runs along
+            # contiguous memory.
+            tile = l2_dist_block(x2_block, x1[refs], x2_sq, x1_sq[refs],
+                                 squared=True)
+            tile_dists, tile_idx = topk_by_index(tile, k)
+            tile_idx += j
+
+            # Merge with the nearest samples found in previous tiles
+            if best_dists is not None:
+                tile_dists = torch.cat((best_dists, tile_dists), dim=1)
+                tile_idx = torch.cat((best_idx, tile_idx), dim=1)
+            best_dists, best_idx = topk_by_index(tile_dists, k, tile_idx)
+
+        out_dists[queries] = best_dists
+        out_idx[queries] = best_idx
+
+    if not squared:
+        out_dists.sqrt_()
+    return out_dists, out_idx
+
+
+def topk_by_index(dists: Tensor, k, idx: Tensor = None):
+    """
+    Finds the k smallest distances in each row, breaking ties by the lower
+    index, so that the result doesn't depend on the order of the candidates.
+    :param dists: Tensor of shape (N, C) with the distances of candidates.
+    :param k: Number of candidates to keep.
+    :param idx: Optional tensor of shape (N, C) with the indices of the
+        candidates, distinct within each row. Defaults to their columns.
+    :return: A tuple (dists, idx) of tensors of shape (N, min(k, C)), sorted
+        by distance and then by index.
+    """
+    n_cols = dists.shape[1]
+    k = min(k, n_cols)
+    if idx is None:
+        idx = torch.arange(n_cols).expand_as(dists)
+    if k == 0:
+        return dists[:, :0], idx[:, :0]
+
+    if k < n_cols:
+        # The candidate after the k-th tells the rows with ties at the k-th
+        # distance, which are the only ones topk() may get wrong.
+        top_dists, top = torch.topk(dists, k + 1, dim=1, largest=False)
+        kth = top_dists[:, k - 1:k]
+        top = top[:, :k]
+        tied = top_dists[:, k] == kth[:, 0]
+        if tied.any():
+            # Rows are indexed with a slice when all of them are tied, which
+            # avoids copying them.
+            tied = slice(None) if tied.all() else tied.nonzero().flatten()
+            # Of the candidates at the k-th distance, keep those with the
+            # lowest indices, along with all the nearer ones.
+            tied_dists, kth = dists[tied], kth[tied]
+            key = idx[tied].masked_fill(tied_dists > kth,
+                                        torch.iinfo(torch.int64).max)
+            key.masked_fill_(tied_dists < kth, torch.iinfo(torch.int64).min)
+            top[tied] = torch.topk(key, k, dim=1, largest=False,
+                                   sorted=False).indices
+        dists = torch.gather(dists, 1, top)
+        idx = torch.gather(idx, 1, top)
+
+    # Sort by index, and then stably by distance
+    order = torch.argsort(idx, dim=1)
+    dists = torch.gather(dists, 1, order)
+    idx = torch.gather(idx, 1, order)
+    dists, order = torch.sort(dists, dim=1, stable=True)
+    return dists, torch.gather(idx, 1, order)
+
+
+def _element_size(dtype):
+    return torch.empty((), dtype=dtype).element_size()
@@ -1,3 +1,7 @@
+import json
+import os
+import threading
+
 import numpy as np
 import torch
 from torch import Tensor
@@ -5,14 +9,75 @@ from torch.utils.data import Dataset, DataLoader, Subset
 
 import cs236781.dataloader_utils as dataloader_utils
 from . import dataloaders
+from . import knn_index
+from .chunked import ChunkedTensor, append_rows
+from .distances import DEFAULT_TILE_BYTES, l2_dist_block, sq_norms
+from .quantization import QuantizedTensor, STORAGE_TYPES
+
+# Datasets up to this size are loaded into memory once for cross-validation.
+DEFAULT_IN_MEMORY_BYTES = 2 * 1024 ** 3
+
+# Batch size used when loading a dataset for cross-validation.
+LOAD_BATCH_SIZE = 1024
+
+# Model tensors written by KNNClassifier.save(), each to its own .npy file.
+# The scales are only saved for training samples stored as int8.
+SAVED_TENSORS = ('x_train', 'x_train_scales', 'x_train_sq', 'y_train', 'ids')
+
+# Fraction of removed training samples above which a model is compacted in
+# the background.
+DEFAULT_COMPACT_RATIO = 0.25
 
 
 class KNNClassifier(object):
-    def __init__(self, k):
+    def __init__(self, k, max_tile_bytes=DEFAULT_TILE_BYTES, backend='brute',
+                 storage=None, compact_ratio=DEFAULT_COMPACT_RATIO,
+                 **backend_kw):
+        """
+        :param k: Number of nearest neighbors to use for prediction.
+        :param max_tile_bytes: Memory budget of a single distance tile used
+            when searching for neighbors. Peak memory of predict() is bound
+            by this value rather than by the train and test set sizes.
+        :param backend: Name of the neighbors index built during training,
+            one of knn_index.INDEX_TYPES: 'brute' for exact search, 'kdtree'
+            or 'balltree' for exact search on low-dimensional data, 'ivf'
+            for approximate search, or 'auto' to choose an exact backend
+            based on the size and dimension of the training set.
+        :param storage: Optional reduced-precision format of the stored
+            training samples, one of quantization.STORAGE_TYPES: 'float16',
+            or 'int8' with a scale per sample. Distances are still computed
+            in float32, a block of training samples at a time. Not supported
+            by the 'kdtree' and 'balltree' backends, whose trees keep their
+            own float64 copy of the samples; 'auto' then always chooses
+            'brute'.
+        :param compact_ratio: Fraction of training samples which remove()
+            may leave as tombstones before the model is compacted in the
+            background. None disables automatic compaction.
+        :param backend_kw: Extra arguments of the index, e.g. nprobe for
+            'ivf', which trades recall for speed.
+        """
+        if storage and backend in ('kdtree', 'balltree'):
+            raise ValueError(f"The {backend} backend doesn't support "
+                             f"{storage} storage")
+
         self.k = k
+        self.max_tile_bytes = max_tile_bytes
+        self.backend = backend
+        self.backend_kw = backend_kw
+        self.storage = storage
+        self.compact_ratio = compact_ratio
         self.x_train = None
+        self.x_train_sq = None
         self.y_train = None
+        self.ids = None
         self.n_classes = None
+        self.index = None
+        self.n_removed = 0
+        self._next_id = 0
+        self._buffers = None
+        self._lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._compaction = None
 
     def train(self, dl_train: DataLoader):
         """
@@ -22,9 +87,6 @@ class KNNClassifier(object):
             return tuples).
         :return: self
         """
-        x, y = next(iter(dl_train))  
-        x_train = x
-        y_train = y
         # TODO:
         #  Convert the input dataloader into x_train, y_train and n_classes.
         #  1. You should join all the samples returned from the dataloader into
@@ -32,21 +94,227 @@ class KNNClassifier(object):
         #     y_train.
         #  2. Save the number of classes as n_classes.
         # ====== YOUR CODE: ======
-        count = 0
-        for x,y in dl_train:
-            if count == 0:
-                pass
-            else:
-                x_train = torch.cat((x_train,x))
-                y_train = torch.cat((y_train,y))
-                
-            count = count+1
+        if self.storage:
+            # Quantize each batch as it's loaded, so that the samples are
+            # never all held in full precision.
+            samples = self._load_quantized(dl_train)
+        else:
+            samples = dataloader_utils.flatten(dl_train)
+        if not samples:
+            raise ValueError("Can't train on an empty DataLoader")
+        x_train, y_train = samples
         # ========================
-        self.x_train = x_train
-        self.y_train = y_train
-        self.n_classes = x_train.shape[0]
+        return self.train_tensors(x_train, y_train)
+
+    def _load_quantized(self, dl: DataLoader):
+        """
+        Loads the samples of a DataLoader in the model's storage format.
+        :return: A tuple (x, y) of a QuantizedTensor with the samples and a
+            tensor with their labels, or an empty tuple if dl is empty.
+        """
+        x_batches, y, n = [], None, 0
+        for x_batch, y_batch in dl:
+            x_batches.append(QuantizedTensor.quantize(x_batch, self.storage))
+            if y is None:
+                y = y_batch.new_empty((0, *y_batch.shape[1:]))
+            y = append_rows(y, n, y_batch)
+            n += y_batch.shape[0]
+        if not x_batches:
+            return ()
+        return QuantizedTensor.cat(x_batches), y[:n]
+
+    def train_tensors(self, x_train: Tensor, y_train: Tensor,
+                      x_train_sq: Tensor = None, n_classes=None,
+                      ids: Tensor = None):
+        """
+        Trains the KNN model from samples which are already in memory.
+        :param x_train: Tensor of shape (N,D) with the training samples, or a
+            QuantizedTensor of them.
+        :param y_train: Tensor of shape (N,) with the training labels.
+        :param x_train_sq: Optional precomputed squared norms of the
+            training samples, shape (N,).
+        :param n_classes: Optional number of classes. Defaults to the
+            largest label plus one.
+        :param ids: Optional increasing ids of the training samples.
+            Defaults to their indices.
+        :return: self
+        """
+        if self.storage and not isinstance(x_train, QuantizedTensor):
+            x_train = QuantizedTensor.quantize(x_train, self.storage)
+        if x_train_sq is None:
+            x_train_sq = sq_norms(x_train, self.max_tile_bytes)
+        if n_classes is None:
+            n_classes = int(y_train.max()) + 1
+        if ids is None:
+            ids = torch.arange(x_train.shape[0])
+
+        with self._lock:
+            self._set_samples(x_train, x_train_sq, y_train, ids,
+                              self._build_index(x_train, x_train_sq))
+            self.n_classes = n_classes
+            self._next_id = int(ids[-1]) + 1
         return self
 
+    def add(self, x: Tensor, y: Tensor):
+        """
+        Adds labeled samples to the model, updating its index instead of
+        rebuilding it. The samples are appended to chunked storage, so this
+        takes amortized O(M) time on top of the index's update.
+        :param x: Tensor of shape (M,D) with the new samples.
+        :param y: Tensor of shape (M,) with their labels.
+        :return: A tensor of shape (M,) with the ids given to the samples,
+            which can be passed to remove().
+        """
+        if self.x_train is None:
+            return self.train_tensors(x, y).ids
+
+        if self.storage:
+            x = QuantizedTensor.quantize(x, self.storage)
+        x_sq = sq_norms(x, self.max_tile_bytes)
+        with self._lock:
+            ids = torch.arange(self._next_id, self._next_id + x.shape[0])
+            self._append(x, x_sq, y, ids)
+            self.n_classes = max(self.n_classes, int(y.max()) + 1)
+        return ids
+
+    def remove(self, ids):
+        """
+        Removes training samples from the model. They're tombstoned by
+        setting their squared norm to inf, so that searches skip them, and
+        dropped from storage by the next compaction.
+        :param ids: Ids of the samples to remove, as returned by add(). The
+            samples the model was trained with have their indices as ids.
+        """
+        ids = torch.as_tensor(ids, dtype=torch.int64).flatten()
+        with self._lock:
+            rows = torch.searchsorted(self.ids, ids) \
+                .clamp_(max=len(self.ids) - 1)
+            found = (self.ids[rows] == ids) & \
+                torch.isfinite(self.x_train_sq[rows])
+            if not found.all():
+                raise ValueError(f"Unknown ids: {ids[~found].tolist()}")
+            self._remove_rows(torch.unique(rows))
+
+            n_live = len(self.ids) - self.n_removed
+            if self.compact_ratio is not None and n_live > 0 and \
+                    self.n_removed > self.compact_ratio * len(self.ids) and \
+                    not (self._compaction and self._compaction.is_alive()):
+                self._compaction = self.compact(background=True)
+
+    def compact(self, background=False):
+        """
+        Drops removed samples from the model's storage and rebuilds its
+        index over the remaining ones, which are stored contiguously again.
+        The indices of the samples change, but not their ids.
+        :param background: Whether to compact on a background thread.
+            Searches aren't blocked meanwhile, and add() and remove() only
+            while the compacted model is swapped in.
+        :return: The background thread, or None.
+        """
+        if background:
+            thread = threading.Thread(target=self.compact, daemon=True)
+            thread.start()
+            return thread
+
+        with self._compact_lock:
+            with self._lock:
+                x_train, n = self.x_train, len(self.ids)
+                live = torch.isfinite(self.x_train_sq).nonzero().flatten()
+                if len(live) == 0:
+                    raise ValueError("Can't compact a model with no samples")
+                x_train_sq = self.x_train_sq[live]
+                y_train = self.y_train[live]
+                ids = self.ids[live]
+
+            # Samples are never modified after being stored, so they can be
+            # copied and indexed without holding the lock.
+            x_train = x_train.index_select(0, live)
+            index = self._build_index(x_train, x_train_sq)
+
+            with self._lock:
+                # Catch up with samples added and removed meanwhile
+                added = slice(n, len(self.ids))
+                x_added = self.x_train.index_select(
+                    0, torch.arange(added.start, added.stop))
+                added = (x_added, self.x_train_sq[added].clone(),
+                         self.y_train[added].clone(), self.ids[added].clone())
+                removed = torch.isinf(self.x_train_sq[live]).nonzero() \
+                    .flatten()
+
+                self._set_samples(x_train, x_train_sq, y_train, ids, index)
+                if len(added[-1]) > 0:
+                    self._append(*added)
+                if len(removed) > 0:
+                    self._remove_rows(removed)
+
+    def save(self, path):
+        """
+        Saves a trained model to a directory, as .npy files of the training
+        samples, their squared norms, labels and ids, which load() can map
+        into memory without copying. The model is compacted first if samples
+        were added or removed since it was trained.
+        :param path: Path of the directory to save to.
+        """
+        if self.n_removed > 0 or isinstance(self.x_train, ChunkedTensor):
+            self.compact()
+
+        os.makedirs(path, exist_ok=True)
+        tensors = dict(x_train=self.x_train, x_train_sq=self.x_train_sq,
+                       y_train=self.y_train, ids=self.ids)
+        if isinstance(self.x_train, QuantizedTensor):
+            tensors['x_train'] = self.x_train.data
+            if self.x_train.scales is not None:
+                tensors['x_train_scales'] = self.x_train.scales
+        # Each file is written to a temporary path and then renamed, so that
+        # a model can be saved over the files it was loaded (and mapped)
+        # from, and readers never see a partial file.
+        for name, tensor in tensors.items():
+            _replace_file(os.path.join(path, f'{name}.npy'),
+                          lambda f: np.save(f, tensor.numpy()))
+        for name in set(SAVED_TENSORS) - set(tensors):
+            # E.g. the scales of a model saved with int8 storage before
+            if os.path.isfile(os.path.join(path, f'{name}.npy')):
+                os.remove(os.path.join(path, f'{name}.npy'))
+
+        meta = dict(k=self.k, n_classes=self.n_classes,
+                    max_tile_bytes=self.max_tile_bytes, backend=self.backend,
+                    storage=self.storage, compact_ratio=self.compact_ratio,
+                    backend_kw=self.backend_kw)
+        _replace_file(os.path.join(path, 'meta.json'),
+                      lambda f: f.write(json.dumps(meta).encode()))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads a model saved with save(). The brute-force index is ready
+        immediately, while other indexes are rebuilt from the saved samples.
+        :param path: Path of the directory the model was saved to.
+        :param mmap: Whether to map the saved tensors into memory instead of
+            reading them. Mapped pages are loaded lazily and shared by all
+            processes that load the same model; they're copy-on-write, so
+            writes don't reach the files or other processes.
+        :return: A trained KNNClassifier.
+        """
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+
+        tensors = {
+            name: torch.from_numpy(np.load(os.path.join(path, f'{name}.npy'),
+                                           mmap_mode='c' if mmap else None))
+            for name in SAVED_TENSORS
+            if os.path.isfile(os.path.join(path, f'{name}.npy'))
+        }
+        if meta['storage']:
+            tensors['x_train'] = QuantizedTensor(
+                tensors['x_train'], tensors.pop('x_train_scales', None))
+
+        model = cls(meta['k'], max_tile_bytes=meta['max_tile_bytes'],
+                    backend=meta['backend'], storage=meta['storage'],
+                    compact_ratio=meta.get('compact_ratio',
+                                           DEFAULT_COMPACT_RATIO),
+                    **meta['backend_kw'])
+        return model.train_tensors(**tensors, n_classes=meta['n_classes'])
+
     def predict(self, x_test: Tensor):
         """
         Predict the most likely class for each sample in a given tensor.
@@ -54,39 +322,152 @@ class KNNClassifier(object):
         :return: A tensor of shape (N,) containing the predicted classes.
         """
 
-        # Calculate distances between training and test samples
-        dist_matrix = l2_dist(self.x_train,x_test)
-        
-        
+        # Find the nearest training samples of each test sample
+        _, nn_idx, y_train = self._kneighbors(x_test, self.k)
+
         # TODO:
         #  Implement k-NN class prediction based on distance matrix.
         #  For each training sample we'll look for it's k-nearest neighbors.
         #  Then we'll predict the label of that sample to be the majority
         #  label of it's nearest neighbors.
+        #  Don't use an explicit loop.
 
-        n_test = x_test.shape[0]
-        y_pred = torch.zeros(n_test, dtype=torch.int64)
-        for i in range(n_test):
-            # TODO:
-            #  - Find indices of k-nearest neighbors of test sample i
-            #  - Set y_pred[i] to the most common class among them
-            #  - Don't use an explicit loop.
-            # ====== YOUR CODE: ======
-            curr_dist = dist_matrix[:,i]
-            _,top_idx = torch.topk(curr_dist,self.k,largest = False)
-            labels = self.y_train[top_idx]
-            y_pred[i] = torch.bincount(labels).argmax()
-            # ========================
+        # ====== YOUR CODE: ======
+        y_pred = majority_vote(y_train[nn_idx], self.n_classes)
+        # ========================
 
         return y_pred
 
+    def predict_k_choices(self, x_test: Tensor, k_choices):
+        """
+        Predict the classes of the given samples for several values of k.
+        Neighbors are searched for only once, with the largest k, and the
+        prediction for each k is a vote among a prefix of them.
+        :param x_test: Tensor of shape (N,D) where N is the number of samples.
+        :param k_choices: A sequence of values of k.
+        :return: A list with a tensor of shape (N,) containing the predicted
+            classes for each value in k_choices.
+        """
+        _, nn_idx, y_train = self._kneighbors(x_test, max(k_choices))
+        nn_labels = y_train[nn_idx]
+        return [majority_vote(nn_labels[:, :k], self.n_classes)
+                for k in k_choices]
+
+    def kneighbors(self, x_test: Tensor, k=None):
+        """
+        Finds the nearest training samples of each sample in a given tensor,
+        using the index built during training.
+        :param x_test: Tensor of shape (N,D) where N is the number of samples.
+        :param k: Number of neighbors to find. Defaults to the model's k.
+        :return: A tuple (dists, idx) of tensors of shape (N, k) with the
+            squared distances and training set indices of the neighbors,
+            sorted from nearest to farthest. The ids of the neighbors are
+            self.ids[idx], as long as the model isn't compacted meanwhile.
+        """
+        dists, idx, _ = self._kneighbors(x_test, k or self.k)
+        return dists, idx
+
+    def _kneighbors(self, x_test: Tensor, k):
+        # Take the index and the labels together, since compaction may
+        # replace both during the search.
+        with self._lock:
+            index, y_train = self.index, self.y_train
+            n_live = len(y_train) - self.n_removed
+        if k > n_live:
+            raise ValueError(f"Can't find {k} neighbors among {n_live}")
+        dists, idx = index.search(x_test.to(self.x_train.dtype), k)
+        return dists, idx, y_train
+
+    def _build_index(self, x_train, x_train_sq: Tensor):
+        backend = self.backend
+        if backend == 'auto':
+            backend = 'brute' if self.storage else \
+                knn_index.auto_backend(*x_train.shape)
+        return knn_index.create_index(
+            backend, max_tile_bytes=self.max_tile_bytes, **self.backend_kw
+        ).build(x_train, x_train_sq)
+
+    def _set_samples(self, x_train, x_train_sq: Tensor, y_train: Tensor,
+                     ids: Tensor, index):
+        self.x_train = x_train
+        self.x_train_sq = x_train_sq
+        self.y_train = y_train
+        self.ids = ids
+        self.index = index
+        self.n_removed = int(torch.isinf(x_train_sq).sum())
+        # The norms, labels and ids are views of buffers with spare capacity
+        # once samples are added.
+        self._buffers = dict(x_train_sq=x_train_sq, y_train=y_train, ids=ids)
+
+    def _append(self, x, x_sq: Tensor, y: Tensor, ids: Tensor):
+        n = len(self.ids)
+        if not isinstance(self.x_train, ChunkedTensor):
+            self.x_train = ChunkedTensor(self.x_train)
+        self.x_train.append(x)
+        for name, values in dict(x_train_sq=x_sq, y_train=y, ids=ids).items():
+            buf = append_rows(self._buffers[name], n, values)
+            self._buffers[name] = buf
+            setattr(self, name, buf[:n + len(values)])
+        self.index.add(self.x_train, self.x_train_sq, len(ids))
+        self.n_removed += int(torch.isinf(x_sq).sum())
+        self._next_id = max(self._next_id, int(ids[-1]) + 1)
+
+    def _remove_rows(self, rows: Tensor):
+        self.x_train_sq[rows] = float('inf')
+        self.index.remove(rows)
+        self.n_removed += len(rows)
+
+
+def _replace_file(path, write):
+    """
+    Writes a file to a temporary path and renames it to the given path,
+    replacing any existing file at once.
+    :param write: A function which writes the content to a binary file.
+    """
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _dataset_nbytes(ds: Dataset):
+    """
+    Estimates the memory needed to hold all samples of a dataset, based on
+    its first sample.
+    """
+    x0, _ = ds[0]
+    x0 = torch.as_tensor(x0)
+    return len(ds) * x0.numel() * x0.element_size()
+
+
+def majority_vote(nn_labels: Tensor, n_classes):
+    """
+    Calculates the most common label among the neighbors of each sample.
+    Ties are broken deterministically in favor of the smallest label.
+    :param nn_labels: Tensor of shape (N, k) with the labels of the k
+        neighbors of each of N samples.
+    :param n_classes: Number of classes; labels are in range [0, n_classes).
+    :return: A tensor of shape (N,) containing the majority label per sample.
+    """
+    n, k = nn_labels.shape
+    counts = torch.zeros(n, n_classes, dtype=torch.int64)
+    counts.scatter_add_(1, nn_labels, torch.ones(1, 1, dtype=torch.int64)
+                        .expand(n, k))
+
+    # Make every count unique by ranking smaller labels higher among equal
+    # counts, so argmax doesn't depend on the tie-breaking of the backend.
+    counts.mul_(n_classes)
+    counts.add_(torch.arange(n_classes - 1, -1, -1, dtype=torch.int64))
+    return counts.argmax(dim=1)
 
-def l2_dist(x1: Tensor, x2: Tensor):
+
+def l2_dist(x1: Tensor, x2: Tensor, squared=False):
     """
     Calculates the L2 (euclidean) distance between each sample in x1 to each
     sample in x2.
     :param x1: First samples matrix, a tensor of shape (N1, D).
     :param x2: Second samples matrix, a tensor of shape (N2, D).
+    :param squared: Whether to return squared distances, skipping the sqrt.
     :return: A distance matrix of shape (N1, N2) where the entry i, j
     represents the distance between x1 sample i and x2 sample j.
     """
@@ -101,34 +482,9 @@ def l2_dist(x1: Tensor, x2: Tensor):
     #    combine the three terms efficiently.
 
     # ====== YOUR CODE: ======
-    x1_sum_vec = (x1**2).sum(dim=1)
-    x2_sum_vec = (x2**2).sum(dim=1)
-    
-    mul_mat = x1@x2.T
-    x1_sum_vec = x1_sum_vec.view(-1,1)
-   # x2_sum_vec = x2_sum_vec.view(1,-1)
-    
-    total_sum = x1_sum_vec + x2_sum_vec
-    dists = total_sum - 2*mul_mat
-    dists = dists ** 0.5
-    
-    '''
-    x2_singletons = x2.view(x2_dims[0], 1, x2_dims[1])
-
-    # every x1 sample minus every x2 sample via broadcasting
-    sub_t = x1 - x2_singletons;
-    sqr_t = sub_t ** 2
-    #sqr_t = (x1 - x2_singletons)**2
-    sqr_singletons = sqr_t.view(x1_dims[0] * x2_dims[0], x1_dims[1]) # rearrange vectors
-    sum_singletons = sqr_singletons.sum(1)
-
-    # we use a transposed dims of the requested tensor for a faster
-    # arrangment of the data
-    dists = (sum_singletons ** 0.5).view(x2_dims[0], x1_dims[0])
-    
-    # and now rearrange as needed
-    dists = dists.T
-    '''
+    x1_sq = (x1 ** 2).sum(dim=1)
+    x2_sq = (x2 ** 2).sum(dim=1)
+    dists = l2_dist_block(x1, x2, x1_sq, x2_sq, squared)
     # ========================
 
     return dists
@@ -154,52 +510,104 @@ def accuracy(y: Tensor, y_pred: Tensor):
     return accuracy
 
 
-def find_best_k(ds_train: Dataset, k_choices, num_folds):
+def benchmark_storage(x_train: Tensor, y_train: Tensor, x_test: Tensor,
+                      y_test: Tensor, k, storages=STORAGE_TYPES):
+    """
+    Compares KNN classification with reduced-precision training samples to
+    classification with the samples as given.
+    :param x_train: Tensor of shape (N,D) with the training samples.
+    :param y_train: Tensor of shape (N,) with the training labels.
+    :param x_test: Tensor of shape (M,D) with the test samples.
+    :param y_test: Tensor of shape (M,) with the test labels.
+    :param k: Number of neighbors of the model.
+    :param storages: Storage formats to compare.
+    :return: A dict from each storage format (and None for the samples as
+        given) to a dict with the nbytes of the stored samples, the recall
+        of the exact neighbors, the accuracy and its difference from the
+        accuracy with the samples as given.
+    """
+    results = {}
+    exact_idx, exact_acc = None, None
+    for storage in (None, *storages):
+        model = KNNClassifier(k, storage=storage).train_tensors(x_train,
+                                                               y_train)
+        _, nn_idx = model.kneighbors(x_test)
+        y_pred = majority_vote(model.y_train[nn_idx], model.n_classes)
+        acc = accuracy(y_test, y_pred)
+        if exact_idx is None:
+            exact_idx, exact_acc = nn_idx, acc
+
+        nbytes = model.x_train.nbytes if storage else \
+            model.x_train.numel() * model.x_train.element_size()
+        results[storage] = dict(nbytes=nbytes,
+                                recall=knn_index.recall_at_k(nn_idx,
+                                                             exact_idx),
+                                accuracy=acc,
+                                accuracy_delta=acc - exact_acc)
+    return results
+
+
+def find_best_k(ds_train: Dataset, k_choices, num_folds,
+                max_in_memory_bytes=DEFAULT_IN_MEMORY_BYTES):
     """
     Use cross validation to find the best K for the kNN model.
 
     :param ds_train: Training dataset.
     :param k_choices: A sequence of possible value of k for the kNN model.
     :param num_folds: Number of folds for cross-validation.
+    :param max_in_memory_bytes: Datasets whose samples fit in this size are
+        loaded into memory once and split into folds by indexing. Larger
+        datasets are loaded from the dataset again for every fold.
     :return: tuple (best_k, accuracies) where:
         best_k: the value of k with the highest mean accuracy across folds
         accuracies: The accuracies per fold for each k (list of lists).
     """
 
-    accuracies = []
     fold_size = int(np.floor(len(ds_train)/num_folds))
-    indices = np.random.choice(len(ds_train), len(ds_train), replace=False)
+    indices = torch.from_numpy(
+        np.random.choice(len(ds_train), len(ds_train), replace=False))
     
-    for i, k in enumerate(k_choices):
-        model = KNNClassifier(k)
+    # TODO:
+    #  Train model num_folds times with different train/val data.
+    #  Don't use any third-party libraries.
+    #  You can use your train/validation splitter from part 1 (note that
+    #  then it won't be exactly k-fold CV since it will be a
+    #  random split each iteration), or implement something else.
 
-        # TODO:
-        #  Train model num_folds times with different train/val data.
-        #  Don't use any third-party libraries.
-        #  You can use your train/validation splitter from part 1 (note that
-        #  then it won't be exactly k-fold CV since it will be a
-        #  random split each iteration), or implement something else.
+    # ====== YOUR CODE: ======
+    # The distances within a fold don't depend on k, so each fold is
+    # evaluated for all values of k from a single neighbors search.
+    model = KNNClassifier(max(k_choices))
+    in_memory = _dataset_nbytes(ds_train) <= max_in_memory_bytes
+    if in_memory:
+        x_all, y_all = dataloader_utils.flatten(
+            DataLoader(ds_train, batch_size=LOAD_BATCH_SIZE))
 
-        # ====== YOUR CODE: ======
-        ith_acc = []
-        for i_fold in range(num_folds):
-            
-            test_indices = indices[i_fold * fold_size : (i_fold + 1) * fold_size]
-            train_indices = np.concatenate((indices[:i_fold * fold_size], indices[(i_fold + 1) * fold_size:]))
-            
-            # test_subset = torch.utils.data.Subset(ds_train, test_indices)
-            test_sampler = torch.utils.data.sampler.SubsetRandomSampler(test_indices)                 
+    fold_accuracies = []
+    for i_fold in range(num_folds):
+
+        test_indices = indices[i_fold * fold_size : (i_fold + 1) * fold_size]
+        train_indices = torch.cat((indices[:i_fold * fold_size], indices[(i_fold + 1) * fold_size:]))
+
+        if in_memory:
+            model.train_tensors(x_all[train_indices], y_all[train_indices])
+            x_test, y_test = x_all[test_indices], y_all[test_indices]
+        else:
+            test_sampler = torch.utils.data.sampler.SubsetRandomSampler(test_indices)
             train_sampler = torch.utils.data.sampler.SubsetRandomSampler(train_indices)
-            
-            model.train(DataLoader(ds_train, sampler=train_sampler))
-            dl_test = DataLoader(ds_train, sampler=test_sampler)
+
+            model.train(DataLoader(ds_train, batch_size=LOAD_BATCH_SIZE,
+                                   sampler=train_sampler))
+            dl_test = DataLoader(ds_train, batch_size=LOAD_BATCH_SIZE,
+                                 sampler=test_sampler)
             x_test, y_test = dataloader_utils.flatten(dl_test)
-             
-            y_pred = model.predict(x_test)
-            ith_acc.append(accuracy(y_test, y_pred))
 
-        accuracies.append(ith_acc)    
-        # ========================
+        y_preds = model.predict_k_choices(x_test, k_choices)
+        fold_accuracies.append([accuracy(y_test, y_pred) for y_pred in y_preds])
+
+    # Transpose into the accuracies per fold for each k
+    accuracies = [list(acc) for acc in zip(*fold_accuracies)]
+    # ========================
 
     best_k_idx = np.argmax([np.mean(acc) for acc in accuracies])
     best_k = k_choices[best_k_idx]
@@ -0,0 +1,153 @@
+import collections
+import contextlib
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, List
+
+import torch
+from torch import Tensor
+
+from .knn_classifier import KNNClassifier
+
+# torch's number of threads before any executor lowered it, and the number
+# of predict() calls currently running with it lowered.
+_threads_lock = threading.Lock()
+_saved_threads = None
+_n_limited = 0
+
+
+class QueryStats(NamedTuple):
+    """
+    Counters of the queries executed by a KNNQueryExecutor.
+    The latency is per shard, from the start of its search until its
+    predictions are ready.
+    """
+    n_queries: int
+    total_time: float
+    shard_sizes: List[int]
+    shard_latencies: List[float]
+
+    @property
+    def queries_per_sec(self):
+        return self.n_queries / self.total_time if self.total_time else 0.
+
+
+class KNNQueryExecutor(object):
+    """
+    Runs KNNClassifier predictions over shards of the test samples on a pool
+    of threads. Each shard's search is a separate, cache-sized operation.
+    During predict(), torch's intra-op threads are divided between the
+    workers so that the host isn't oversubscribed.
+    """
+
+    def __init__(self, model: KNNClassifier, n_workers=None, shard_size=1024,
+                 max_pending=None):
+        """
+        :param model: A trained KNNClassifier.
+        :param n_workers: Number of worker threads. Defaults to the number of
+            CPUs.
+        :param shard_size: Number of test samples per shard.
+        :param max_pending: Maximal number of shards submitted and not yet
+            consumed, which bounds the memory held by results. Defaults to
+            twice the number of workers.
+        """
+        self.model = model
+        self.n_workers = n_workers or os.cpu_count() or 1
+        self.shard_size = shard_size
+        self.max_pending = max_pending or 2 * self.n_workers
+        self.reset_stats()
+
+    def stream(self, x_test: Tensor):
+        """
+        Predicts the classes of test samples shard by shard.
+        :param x_test: Tensor of shape (N,D) where N is the number of samples.
+        :return: A generator of (shard, y_pred) tuples, in the order of the
+            shards, where shard is a slice of x_test and y_pred holds its
+            predicted classes. The stats are updated as shards complete.
+            torch's number of intra-op threads isn't changed, since the
+            caller runs between the shards; see predict().
+        """
+        n = x_test.shape[0]
+        shards = (slice(i, min(i + self.shard_size, n))
+                  for i in range(0, n, self.shard_size))
+
+        start = time.perf_counter()
+        try:
+            with ThreadPoolExecutor(self.n_workers) as pool:
+                pending = collections.deque()
+                for shard in shards:
+                    future = pool.submit(self._predict_shard, x_test[shard])
+                    pending.append((shard, future))
+                    if len(pending) >= self.max_pending:
+                        yield self._complete(*pending.popleft(), start)
+                while pending:
+                    yield self._complete(*pending.popleft(), start)
+        finally:
+            self._prev_time = self._total_time
+
+    def predict(self, x_test: Tensor):
+        """
+        Predicts the classes of test samples, searching shards in parallel.
+        Until it returns, torch's number of intra-op threads is lowered for
+        the whole process, so that each worker gets an even share of them.
+        :param x_test: Tensor of shape (N,D) where N is the number of samples.
+        :return: A tensor of shape (N,) containing the predicted classes.
+        """
+        y_pred = torch.empty(x_test.shape[0], dtype=torch.int64)
+        with _limited_threads(self.n_workers):
+            for shard, shard_pred in self.stream(x_test):
+                y_pred[shard] = shard_pred
+        return y_pred
+
+    @property
+    def stats(self):
+        """
+        :return: A QueryStats of all queries since the last reset_stats().
+        """
+        return QueryStats(n_queries=sum(self._shard_sizes),
+                          total_time=self._total_time,
+                          shard_sizes=list(self._shard_sizes),
+                          shard_latencies=list(self._shard_latencies))
+
+    def reset_stats(self):
+        self._prev_time = 0.
+        self._total_time = 0.
+        self._shard_sizes = []
+        self._shard_latencies = []
+
+    def _predict_shard(self, x: Tensor):
+        start = time.perf_counter()
+        y_pred = self.model.predict(x)
+        return y_pred, time.perf_counter() - start
+
+    def _complete(self, shard, future, start):
+        y_pred, latency = future.result()
+        self._shard_sizes.append(len(y_pred))
+        self._shard_latencies.append(latency)
+        self._total_time = self._prev_time + time.perf_counter() - start
+        return shard, y_pred
+
+
+@contextlib.contextmanager
+def _limited_threads(n_workers):
+    """
+    Divides torch's intra-op threads between n_workers while in the context.
+    Contexts of concurrent predict() calls may overlap: the number of threads
+    in use before the first one is restored when the last one exits.
+    """
+    global _saved_threads, _n_limited
+    with _threads_lock:
+        if _n_limited == 0:
+            _saved_threads = torch.get_num_threads()
+        _n_limited += 1
+        torch.set_num_threads(min(torch.get_num_threads(),
+                                  max(1, _saved_threads // n_workers)))
+    try:
+        yield
+    finally:
+        with _threads_lock:
+            _n_limited -= 1
+            if _n_limited == 0:
+                torch.set_num_threads(_saved_threads)
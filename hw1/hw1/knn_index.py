@@ -0,0 +1,627 @@
+import abc
+import math
+import threading
+import time
+
+import torch
+from torch import Tensor
+from sklearn.neighbors import BallTree, KDTree
+
+from .chunked import ChunkedTensor, append_rows
+from .distances import DEFAULT_TILE_BYTES, l2_topk, sq_norms, topk_by_index
+
+# Number of samples per cluster used to fit the IVF centroids.
+KMEANS_SAMPLES_PER_CLUSTER = 256
+
+# Feature dimension up to which the 'auto' backend uses a KD-tree. Beyond it,
+# trees prune too little to beat tiled brute-force search, unless the data
+# has a much lower intrinsic dimension (where a ball-tree may be worthwhile).
+AUTO_KDTREE_MAX_FEATURES = 10
+
+# Below this number of reference samples the 'auto' backend uses brute-force
+# search, since building a tree doesn't pay off.
+AUTO_TREE_MIN_SAMPLES = 1024
+
+# Fraction of a tree's samples which can be removed before it's rebuilt.
+DEFAULT_REBUILD_RATIO = 0.25
+
+# Relative tolerance of the tree's distances, within which its samples are
+# checked for ties with the k-th nearest neighbor.
+TIE_RTOL = 1e-5
+
+# Number of rows of the chunks the samples added to an IVF list are copied
+# into. It's small since every list gets chunks of its own.
+ADDED_LIST_CHUNK_ROWS = 64
+
+
+class NeighborsIndex(abc.ABC):
+    """
+    A search structure over a set of reference samples, which finds the
+    nearest reference samples of query samples.
+    """
+
+    def __init__(self, max_tile_bytes=DEFAULT_TILE_BYTES):
+        """
+        :param max_tile_bytes: Memory budget of a single distance tile.
+        """
+        self.max_tile_bytes = max_tile_bytes
+
+    @abc.abstractmethod
+    def build(self, x: Tensor, x_sq: Tensor = None):
+        """
+        Builds the index over a set of reference samples.
+        :param x: Tensor of shape (N,D) with the reference samples.
+        :param x_sq: Optional precomputed squared norms of x, shape (N,).
+        :return: self
+        """
+        pass
+
+    @abc.abstractmethod
+    def search(self, x: Tensor, k):
+        """
+        Finds the nearest reference samples of each query sample.
+        :param x: Tensor of shape (M,D) with the query samples.
+        :param k: Number of neighbors to find.
+        :return: A tuple (dists, idx) of tensors of shape (M, k) with the
+            squared distances and reference indices of the neighbors,
+            sorted from nearest to farthest.
+        """
+        pass
+
+    @abc.abstractmethod
+    def add(self, x: Tensor, x_sq: Tensor, n_new):
+        """
+        Updates a built index after reference samples were appended, without
+        rebuilding it. The new samples are numbered after the existing ones.
+        :param x: All reference samples, the new ones last, e.g. a
+            chunked.ChunkedTensor the new samples were appended to.
+        :param x_sq: Squared norms of all reference samples, shape (N,).
+        :param n_new: Number of new samples at the end of x.
+        """
+        pass
+
+    @abc.abstractmethod
+    def remove(self, idx: Tensor):
+        """
+        Excludes reference samples from future searches, without renumbering
+        the others. Indexes which hold the x_sq passed to them tombstone the
+        removed samples by setting their norm to inf.
+        :param idx: Tensor with the indices of the samples to remove.
+        """
+        pass
+
+
+class BruteForceIndex(NeighborsIndex):
+    """
+    Exact search, comparing each query to all reference samples.
+    """
+
+    def __init__(self, max_tile_bytes=DEFAULT_TILE_BYTES):
+        super().__init__(max_tile_bytes)
+        self.x = None
+        self.x_sq = None
+
+    def build(self, x: Tensor, x_sq: Tensor = None):
+        self.x = x
+        self.x_sq = sq_norms(x, self.max_tile_bytes) if x_sq is None else x_sq
+        return self
+
+    def search(self, x: Tensor, k):
+        # Samples are appended to x before add() updates x_sq, so only the
+        # samples which x_sq covers are searched.
+        x_sq = self.x_sq
+        x_ref = self.x
+        if x_ref.shape[0] > len(x_sq):
+            x_ref = x_ref.head(len(x_sq))
+        return l2_topk(x_ref, x, k, max_tile_bytes=self.max_tile_bytes,
+                       x1_sq=x_sq)
+
+    def add(self, x: Tensor, x_sq: Tensor, n_new):
+        self.x = x
+        self.x_sq = x_sq
+
+    def remove(self, idx: Tensor):
+        # Removed samples are farther than any other, so they're never
+        # among the nearest neighbors while enough samples remain.
+        self.x_sq[idx] = float('inf')
+
+
+class IVFIndex(NeighborsIndex):
+    """
+    Approximate search with an inverted file index: the reference samples
+    are clustered with k-means, and each query is only compared to the
+    samples of the nprobe clusters with the closest centroids.
+    Samples added after the index was built are assigned to the existing
+    clusters and appended to separate lists, one per cluster, so that the
+    centroids aren't refitted and adding takes amortized O(M).
+    """
+
+    def __init__(self, n_lists=None, nprobe=8, n_iter=10, seed=42,
+                 max_tile_bytes=DEFAULT_TILE_BYTES):
+        """
+        :param n_lists: Number of clusters. Defaults to sqrt(N).
+        :param nprobe: Number of clusters searched per query. Higher values
+            increase recall at the cost of speed; n_lists is exact search.
+        :param n_iter: Number of k-means iterations.
+        :param seed: Seed of the k-means initialization.
+        :param max_tile_bytes: Memory budget of a single distance tile.
+        """
+        super().__init__(max_tile_bytes)
+        self.n_lists = n_lists
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.centroids = None
+        self.x_lists = None
+        self.x_lists_sq = None
+        self.list_order = None
+        self.list_offsets = None
+        self.list_pos = None
+        self.added_lists = None
+        self.added_assignment = None
+        self.added_pos = None
+        self.n_added = 0
+
+    def build(self, x: Tensor, x_sq: Tensor = None):
+        n_lists = min(self.n_lists or max(1, int(math.sqrt(x.shape[0]))),
+                      x.shape[0])
+        max_samples = KMEANS_SAMPLES_PER_CLUSTER * n_lists
+        self.centroids = kmeans(x, n_lists, self.n_iter, self.seed,
+                                max_samples=max_samples,
+                                max_tile_bytes=self.max_tile_bytes)
+
+        if x_sq is None:
+            x_sq = sq_norms(x, self.max_tile_bytes)
+        self.x_lists, self.x_lists_sq, self.list_order, self.list_offsets = \
+            self._make_lists(x, x_sq, self._assign(x))
+        self.list_pos = torch.empty_like(self.list_order)
+        self.list_pos[self.list_order] = torch.arange(len(self.list_order))
+
+        # Each added list is a tuple (x, x_sq, ids, n) of its samples, their
+        # norms and indices, and their number. Tuples are replaced whole, so
+        # that searches read consistent ones while samples are added.
+        self.added_lists = [None] * n_lists
+        self.added_assignment = torch.empty(0, dtype=torch.int64)
+        self.added_pos = torch.empty(0, dtype=torch.int64)
+        self.n_added = 0
+        return self
+
+    def search(self, x: Tensor, k):
+        n_lists = self.centroids.shape[0]
+        nprobe = min(self.nprobe, n_lists)
+        _, probes = l2_topk(self.centroids, x, nprobe,
+                            max_tile_bytes=self.max_tile_bytes)
+        best_dists, best_idx = self._search_lists(x, k, probes)
+
+        # Queries whose probed lists hold less than k (remaining) samples are
+        # searched exhaustively, so that k neighbors are always returned.
+        incomplete = torch.isinf(best_dists).any(dim=1).nonzero().flatten()
+        if len(incomplete) > 0:
+            all_lists = torch.arange(n_lists).expand(len(incomplete), -1)
+            best_dists[incomplete], best_idx[incomplete] = \
+                self._search_lists(x[incomplete], k, all_lists)
+
+        return best_dists, best_idx
+
+    def _search_lists(self, x: Tensor, k, probes: Tensor):
+        """
+        Searches the lists probed by each query.
+        :param probes: Tensor of shape (M, nprobe) with the probed lists.
+        :return: A tuple (dists, idx) as returned by search(), padded with
+            inf distances if the probed lists hold less than k samples.
+        """
+        # Group the queries by the lists they probe
+        n_lists, nprobe = self.centroids.shape[0], probes.shape[1]
+        probe_order = torch.argsort(probes.flatten())
+        probe_queries = probe_order // nprobe
+        probe_offsets = torch.zeros(n_lists + 1, dtype=torch.int64)
+        torch.cumsum(torch.bincount(probes.flatten(), minlength=n_lists),
+                     dim=0, out=probe_offsets[1:])
+        probe_offsets = probe_offsets.tolist()
+
+        best_dists = x.new_full((x.shape[0], k), float('inf'))
+        best_idx = torch.full((x.shape[0], k), -1, dtype=torch.int64)
+        added_lists = list(self.added_lists)
+        list_offsets = self.list_offsets.tolist()
+        for i in range(n_lists):
+            queries = probe_queries[probe_offsets[i]:probe_offsets[i + 1]]
+            if len(queries) == 0:
+                continue
+
+            start, end = list_offsets[i], list_offsets[i + 1]
+            lists = [(self.x_lists[start:end], self.x_lists_sq[start:end],
+                      self.list_order[start:end])]
+            if added_lists[i] is not None:
+                lists.append(_added_list(*added_lists[i]))
+            for x_list, x_list_sq, list_ids in lists:
+                if len(list_ids) == 0:
+                    continue
+                dists, idx = l2_topk(x_list, x[queries],
+                                     min(k, len(list_ids)),
+                                     max_tile_bytes=self.max_tile_bytes,
+                                     x1_sq=x_list_sq)
+                best_dists[queries], best_idx[queries] = _merge_topk(
+                    best_dists[queries], best_idx[queries],
+                    dists, list_ids[idx], k)
+        return best_dists, best_idx
+
+    def add(self, x: Tensor, x_sq: Tensor, n_new):
+        new = torch.arange(x.shape[0] - n_new, x.shape[0])
+        x_new = x.index_select(0, new)
+        assignment = self._assign(x_new)
+        pos = torch.empty_like(assignment)
+
+        order = torch.argsort(assignment, stable=True)
+        offsets = torch.zeros(len(self.added_lists) + 1, dtype=torch.int64)
+        torch.cumsum(torch.bincount(assignment,
+                                    minlength=len(self.added_lists)),
+                     dim=0, out=offsets[1:])
+        offsets = offsets.tolist()
+        for i in torch.unique(assignment).tolist():
+            rows = order[offsets[i]:offsets[i + 1]]
+            x_rows = x_new.index_select(0, rows)
+            if self.added_lists[i] is None:
+                x_list = ChunkedTensor(chunk_rows=ADDED_LIST_CHUNK_ROWS)
+                list_sq, list_ids, n = x_sq.new_empty(0), new.new_empty(0), 0
+            else:
+                x_list, list_sq, list_ids, n = self.added_lists[i]
+            x_list.append(x_rows)
+            list_sq = append_rows(list_sq, n, x_sq[new[rows]])
+            list_ids = append_rows(list_ids, n, new[rows])
+            pos[rows] = torch.arange(n, n + len(rows))
+            self.added_lists[i] = (x_list, list_sq, list_ids, n + len(rows))
+
+        self.added_assignment = append_rows(self.added_assignment,
+                                            self.n_added, assignment)
+        self.added_pos = append_rows(self.added_pos, self.n_added, pos)
+        self.n_added += n_new
+
+    def remove(self, idx: Tensor):
+        n_built = len(self.list_order)
+        built, added = idx[idx < n_built], idx[idx >= n_built] - n_built
+        self.x_lists_sq[self.list_pos[built]] = float('inf')
+        lists, pos = self.added_assignment[added], self.added_pos[added]
+        for i in torch.unique(lists).tolist():
+            self.added_lists[i][1][pos[lists == i]] = float('inf')
+
+    def _make_lists(self, x: Tensor, x_sq: Tensor, assignment: Tensor):
+        # Store the samples of each list contiguously, in the order of their
+        # indices, so that ties within a list are broken by the lower index.
+        n_lists = self.centroids.shape[0]
+        list_order = torch.argsort(assignment, stable=True)
+        list_offsets = torch.zeros(n_lists + 1, dtype=torch.int64)
+        torch.cumsum(torch.bincount(assignment, minlength=n_lists), dim=0,
+                     out=list_offsets[1:])
+        return (x.index_select(0, list_order), x_sq[list_order], list_order,
+                list_offsets)
+
+    def _assign(self, x: Tensor):
+        _, nearest = l2_topk(self.centroids, x, 1,
+                             max_tile_bytes=self.max_tile_bytes)
+        return nearest[:, 0]
+
+
+class TreeIndex(NeighborsIndex):
+    """
+    Exact search with a space-partitioning tree, which prunes most of the
+    reference samples for low-dimensional data.
+    Since the tree can't be updated, samples added after it was built are
+    searched by brute force, and removed ones are filtered out of its
+    results. The tree is rebuilt lazily once the added samples outnumber
+    its samples, or once more than rebuild_ratio of its samples were
+    removed, so that updates take amortized O(M).
+    The tree and the state which refers to its samples are only replaced
+    while holding a lock, and each search reads them once under that lock,
+    so that concurrent searches never mix two versions of the tree.
+    """
+    tree_cls = None
+
+    def __init__(self, leaf_size=40, query_batch_size=4096,
+                 rebuild_ratio=DEFAULT_REBUILD_RATIO,
+                 max_tile_bytes=DEFAULT_TILE_BYTES):
+        """
+        :param leaf_size: Number of samples in a leaf of the tree.
+        :param query_batch_size: Number of queries searched per call to the
+            tree.
+        :param rebuild_ratio: Fraction of the tree's samples which can be
+            removed before it's rebuilt.
+        :param max_tile_bytes: Memory budget of a single distance tile, used
+            for searching samples added after the tree was built.
+        """
+        super().__init__(max_tile_bytes)
+        self.leaf_size = leaf_size
+        self.query_batch_size = query_batch_size
+        self.rebuild_ratio = rebuild_ratio
+        self.tree = None
+        self.tree_ids = None
+        self.tree_removed = None
+        self.n_tree_removed = 0
+        self.x = None
+        self.x_sq = None
+        self.n_built = 0
+        self._lock = threading.Lock()
+
+    def build(self, x: Tensor, x_sq: Tensor = None):
+        with self._lock:
+            self.x = x
+            self.x_sq = sq_norms(x, self.max_tile_bytes) if x_sq is None \
+                else x_sq
+            self._build_tree()
+        return self
+
+    def search(self, x: Tensor, k):
+        with self._lock:
+            n = len(self.x_sq)
+            if n - self.n_built > len(self.tree_ids) or \
+                    self.n_tree_removed > \
+                    self.rebuild_ratio * len(self.tree_ids):
+                self._build_tree()
+            # Rebuilding replaces the tree's state rather than modifying it.
+            # remove() marks samples in tree_removed in place, which searches
+            # may or may not see, like any concurrent removal.
+            tree, tree_ids, tree_removed, n_tree_removed, n_built = \
+                self.tree, self.tree_ids, self.tree_removed, \
+                self.n_tree_removed, self.n_built
+            x_ref, x_ref_sq = self.x, self.x_sq
+        n_added = n - n_built
+
+        # Query one neighbor more than needed, which tells the queries with
+        # ties at the k-th distance, and more for the queries which don't
+        # have enough which weren't removed, doubling their number each time.
+        n_cand = k + 1
+        tree_k = min(n_cand, len(tree_ids))
+        dists = x.new_full((x.shape[0], tree_k), float('inf'))
+        idx = torch.zeros(x.shape[0], tree_k, dtype=torch.int64)
+        queries = torch.arange(x.shape[0])
+        if n_tree_removed > 0:
+            tree_k = min(2 * n_cand, len(tree_ids))
+        while len(queries) > 0:
+            tree_dists, tree_idx = self._query(tree, x[queries], tree_k)
+            removed = tree_removed[tree_idx]
+            tree_dists[removed] = float('inf')
+            dists[queries], idx[queries] = _merge_topk(
+                dists[queries, :0], idx[queries, :0],
+                tree_dists, tree_ids[tree_idx], n_cand)
+            if tree_k == len(tree_ids):
+                break
+            queries = queries[(~removed).sum(dim=1) < n_cand]
+            tree_k = min(2 * tree_k, len(tree_ids))
+
+        if n_added > 0:
+            added = slice(n_built, n)
+            added_dists, added_idx = l2_topk(
+                x_ref[added], x, min(n_cand, n_added),
+                max_tile_bytes=self.max_tile_bytes, x1_sq=x_ref_sq[added])
+            dists, idx = _merge_topk(dists, idx, added_dists,
+                                     added_idx + n_built, n_cand)
+
+        # The tree rounds distances differently than brute-force search, so
+        # the candidates are ranked by distances computed the same way, and
+        # ties at the k-th distance are broken among all the samples at
+        # that distance, as brute-force search does.
+        dists, idx = topk_by_index(
+            _candidate_dists(x_ref, x_ref_sq, x, idx), n_cand, idx)
+        if idx.shape[1] > k:
+            tied = (dists[:, k] <= dists[:, k - 1] * (1 + TIE_RTOL)) & \
+                torch.isfinite(dists[:, k])
+            for q in tied.nonzero().flatten().tolist():
+                radius = math.sqrt(dists[q, k - 1]) * (1 + TIE_RTOL)
+                pos = torch.from_numpy(
+                    tree.query_radius(x[q:q + 1].numpy(), radius)[0])
+                pos = pos[~tree_removed[pos]]
+                cand = torch.cat((tree_ids[pos], idx[q][idx[q] >= n_built]))
+                cand = cand[torch.isfinite(x_ref_sq[cand])].unsqueeze(0)
+                dists[q, :k], idx[q, :k] = (t[0] for t in topk_by_index(
+                    _candidate_dists(x_ref, x_ref_sq, x[q:q + 1], cand), k,
+                    cand))
+        return dists[:, :k], idx[:, :k]
+
+    def add(self, x: Tensor, x_sq: Tensor, n_new):
+        with self._lock:
+            self.x = x
+            self.x_sq = x_sq
+
+    def remove(self, idx: Tensor):
+        with self._lock:
+            self.x_sq[idx] = float('inf')
+            in_tree = idx[idx < self.n_built]
+            pos = torch.searchsorted(self.tree_ids, in_tree) \
+                .clamp_(max=len(self.tree_ids) - 1)
+            pos = torch.unique(pos[self.tree_ids[pos] == in_tree])
+            pos = pos[~self.tree_removed[pos]]
+            self.tree_removed[pos] = True
+            self.n_tree_removed += len(pos)
+
+    def _query(self, tree, x: Tensor, k):
+        """
+        :return: A tuple (dists, idx) of the squared distances and tree
+            positions of the k nearest samples of the tree.
+        """
+        dists = x.new_empty(x.shape[0], k)
+        idx = torch.empty(x.shape[0], k, dtype=torch.int64)
+        for i in range(0, x.shape[0], self.query_batch_size):
+            batch = slice(i, i + self.query_batch_size)
+            batch_dists, batch_idx = tree.query(x[batch].numpy(), k)
+            dists[batch] = torch.from_numpy(batch_dists)
+            idx[batch] = torch.from_numpy(batch_idx)
+        return dists.pow_(2), idx
+
+    def _build_tree(self):
+        # Must be called with the lock held. x may already hold samples
+        # which are still being added, and which x_sq doesn't cover yet.
+        self.n_built = len(self.x_sq)
+        self.tree_ids = torch.isfinite(self.x_sq[:self.n_built]) \
+            .nonzero().flatten()
+        # Indexing dequantizes reduced-precision samples; the tree keeps its
+        # own float64 copy of the samples either way.
+        self.tree = self.tree_cls(self.x[self.tree_ids].numpy(),
+                                  leaf_size=self.leaf_size)
+        self.tree_removed = torch.zeros(len(self.tree_ids), dtype=torch.bool)
+        self.n_tree_removed = 0
+
+
+class KDTreeIndex(TreeIndex):
+    tree_cls = KDTree
+
+
+class BallTreeIndex(TreeIndex):
+    tree_cls = BallTree
+
+
+INDEX_TYPES = dict(brute=BruteForceIndex, ivf=IVFIndex,
+                   kdtree=KDTreeIndex, balltree=BallTreeIndex)
+
+
+def _added_list(x: ChunkedTensor, x_sq: Tensor, ids: Tensor, n):
+    """
+    :return: A tuple (x, x_sq, ids) of the first n samples of a list of added
+        samples, since more may be appended to x concurrently.
+    """
+    if len(x) > n:
+        x = x.head(n)
+    return x, x_sq[:n], ids[:n]
+
+
+def _merge_topk(dists: Tensor, idx: Tensor, new_dists: Tensor,
+                new_idx: Tensor, k):
+    """
+    Merges two sets of neighbors found for the same queries.
+    :return: A tuple (dists, idx) of the k nearest of them, sorted from
+        nearest to farthest, with ties broken by the lower index.
+    """
+    dists = torch.cat((dists, new_dists), dim=1)
+    idx = torch.cat((idx, new_idx), dim=1)
+    return topk_by_index(dists, k, idx)
+
+
+def _candidate_dists(x: Tensor, x_sq: Tensor, queries: Tensor, idx: Tensor):
+    """
+    Calculates the squared distances of queries to some of the reference
+    samples, the same way as distances.l2_dist_block.
+    :param x: Reference samples, shape (N, D).
+    :param x_sq: Squared norms of the reference samples, shape (N,).
+    :param queries: Tensor of shape (M, D) with the query samples.
+    :param idx: Tensor of shape (M, C) with the reference indices of the
+        candidate neighbors of each query.
+    :return: A tensor of shape (M, C) with the squared distances.
+    """
+    refs = x.index_select(0, idx.flatten()).view(*idx.shape, -1)
+    dists = torch.bmm(refs, queries.unsqueeze(2)).squeeze(2)
+    dists.mul_(-2).add_(x_sq[idx])
+    dists.add_((queries ** 2).sum(dim=1, keepdim=True))
+    return dists.clamp_(min=0)
+
+
+def auto_backend(n_samples, n_features):
+    """
+    Chooses an exact search backend based on the reference set's shape.
+    :param n_samples: Number of reference samples.
+    :param n_features: Number of features per sample.
+    :return: A name in INDEX_TYPES.
+    """
+    if n_samples >= AUTO_TREE_MIN_SAMPLES and \
+            n_features <= AUTO_KDTREE_MAX_FEATURES:
+        return 'kdtree'
+    return 'brute'
+
+
+def create_index(backend, **kw):
+    """
+    Creates a neighbors index by name.
+    :param backend: Name of the index type, one of INDEX_TYPES.
+    :param kw: Extra arguments of the index type.
+    :return: A new, unbuilt NeighborsIndex.
+    """
+    if backend not in INDEX_TYPES:
+        raise ValueError(f"Unknown backend: {backend}")
+    return INDEX_TYPES[backend](**kw)
+
+
+def kmeans(x: Tensor, n_clusters, n_iter=10, seed=None, max_samples=None,
+           max_tile_bytes=DEFAULT_TILE_BYTES):
+    """
+    Clusters samples with Lloyd's k-means algorithm.
+    :param x: Tensor of shape (N,D) with the samples to cluster, or any
+        object which returns such tensors when indexed, e.g. a
+        quantization.QuantizedTensor. Such samples are subsampled before
+        they're converted, and then converted a block at a time.
+    :param n_clusters: Number of clusters.
+    :param n_iter: Number of iterations.
+    :param seed: Seed for choosing the initial centroids among the samples.
+    :param max_samples: If given, the centroids are fitted to a random
+        subset of at most this many samples.
+    :param max_tile_bytes: Memory budget of a single distance tile, and of a
+        single block of converted samples.
+    :return: A tensor of shape (n_clusters, D) with the cluster centroids.
+    """
+    gen = torch.Generator()
+    if seed is not None:
+        gen.manual_seed(seed)
+    perm = torch.randperm(x.shape[0], generator=gen)
+    centroids = x[perm[:n_clusters]].clone()
+    if max_samples is not None and max_samples < x.shape[0]:
+        # Selecting rows keeps reduced-precision samples as they are
+        x = x.index_select(0, perm[:max_samples])
+
+    n, d = x.shape
+    block_rows = max(1, max_tile_bytes // (d * centroids.element_size()))
+    for _ in range(n_iter):
+        sums = torch.zeros_like(centroids)
+        counts = torch.zeros(n_clusters, dtype=torch.int64)
+        for i in range(0, n, block_rows):
+            block = x[i:i + block_rows]
+            _, nearest = l2_topk(centroids, block, 1,
+                                 max_tile_bytes=max_tile_bytes)
+            nearest = nearest[:, 0]
+            sums.index_add_(0, nearest, block)
+            counts += torch.bincount(nearest, minlength=n_clusters)
+
+        # Empty clusters keep their previous centroid
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / \
+            counts[nonempty].unsqueeze(1).to(centroids.dtype)
+
+    return centroids
+
+
+def recall_at_k(idx: Tensor, exact_idx: Tensor):
+    """
+    Calculates the fraction of the true nearest neighbors which were found.
+    :param idx: Tensor of shape (M, k) with neighbors found per query.
+    :param exact_idx: Tensor of shape (M, k) with the true neighbors.
+    :return: The recall, as a fraction.
+    """
+    found = (idx.unsqueeze(2) == exact_idx.unsqueeze(1)).any(dim=2)
+    return found.float().mean().item()
+
+
+def benchmark(x_train: Tensor, x_test: Tensor, k, indexes: dict):
+    """
+    Compares the recall and speed of neighbors indexes to exact search.
+    :param x_train: Tensor of shape (N,D) with the reference samples.
+    :param x_test: Tensor of shape (M,D) with the query samples.
+    :param k: Number of neighbors to find per query.
+    :param indexes: A dict from a name to an unbuilt NeighborsIndex.
+    :return: A dict from each name (and 'exact') to a dict with the
+        build_time (sec), queries_per_sec and recall of the index.
+    """
+    exact = BruteForceIndex()
+    indexes = dict(exact=exact, **indexes)
+
+    results = {}
+    exact_idx = None
+    for name, index in indexes.items():
+        start = time.perf_counter()
+        index.build(x_train)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, idx = index.search(x_test, k)
+        search_time = time.perf_counter() - start
+
+        if exact_idx is None:
+            exact_idx = idx
+        results[name] = dict(build_time=build_time,
+                             queries_per_sec=x_test.shape[0] / search_time,
+                             recall=recall_at_k(idx, exact_idx))
+    return results
@@ -1,22 +1,41 @@
+import copy
+import os
+import time
+
 import torch
+import torch.multiprocessing as mp
 from torch import Tensor
 from torch.utils.data import DataLoader
 from collections import namedtuple
 
-from .losses import ClassifierLoss
+from .dataloaders import InMemoryLoader, auto_worker_counts, create_loader
+from .losses import ClassifierLoss, SVMHingeLoss
+
+# Loss and accuracy per epoch, as returned by LinearClassifier.train().
+Result = namedtuple('Result', 'accuracy loss')
+
+# Interval in seconds at which LinearClassifier.train_hogwild() checks that
+# its processes are alive while waiting for them.
+HOGWILD_POLL_SECONDS = 1.
 
 
 class LinearClassifier(object):
 
-    def __init__(self, n_features, n_classes, weight_std=0.001):
+    def __init__(self, n_features, n_classes, weight_std=0.001, bias=False):
         """
         Initializes the linear classifier.
         :param n_features: Number or features in each sample.
         :param n_classes: Number of classes samples can belong to.
         :param weight_std: Standard deviation of initial weights.
+        :param bias: Whether the model adds a bias to the class scores
+            itself, for samples which weren't transformed by the bias trick.
+            The weights then have an extra first row holding the bias, the
+            same layout as with the bias trick, without copying the samples
+            to prepend a feature of ones.
         """
         self.n_features = n_features
         self.n_classes = n_classes
+        self.bias = bias
 
         # TODO:
         #  Create weights tensor of appropriate dimensions
@@ -24,13 +43,17 @@ class LinearClassifier(object):
 
         #self.weights = torch.randn((n_features+1,n_classes))*weight_std
         # ====== YOUR CODE: ======
-        self.weights = torch.randn((n_features,n_classes))*weight_std
+        self.weights = torch.randn((n_features + int(bias), n_classes)) * \
+            weight_std
         # ========================
 
     def predict(self, x: Tensor):
         """
         Predict the class of a batch of samples based on the current weights.
         :param x: A tensor of shape (N,n_features) where N is the batch size.
+            It may be a sparse COO or CSR tensor, whose scores are then a
+            sparse-dense product costing time proportional to its number of
+            nonzeros.
         :return:
             y_pred: Tensor of shape (N,) where each entry is the predicted
                 class of the corresponding sample. Predictions are integers in
@@ -47,7 +70,10 @@ class LinearClassifier(object):
         #y_pred, class_scores = None, None
         # ====== YOUR CODE: ======
                 
-        class_scores = x@self.weights
+        if self.bias:
+            class_scores = torch.addmm(self.weights[0], x, self.weights[1:])
+        else:
+            class_scores = x@self.weights
         _,y_pred =  torch.max(class_scores,dim = 1)
         # ========================
 
@@ -81,9 +107,29 @@ class LinearClassifier(object):
               dl_train: DataLoader,
               dl_valid: DataLoader,
               loss_fn: ClassifierLoss,
-              learn_rate=0.1, weight_decay=0.001, max_epochs=100):
+              learn_rate=0.1, weight_decay=0.001, max_epochs=100,
+              in_memory=False):
+        """
+        Trains the classifier with minibatch SGD.
+        :param dl_train: DataLoader of the training set. Its batches of
+            samples may be sparse COO or CSR tensors, see predict(), unless
+            in_memory is set.
+        :param dl_valid: DataLoader of the validation set.
+        :param loss_fn: The loss to train with.
+        :param learn_rate: Learning rate.
+        :param weight_decay: Weight of the L2 regularization.
+        :param max_epochs: Number of epochs to train.
+        :param in_memory: Whether to load both sets into memory once, and
+            then iterate over minibatches of tensors every epoch instead of
+            over the DataLoaders, reshuffling the training set with a single
+            permutation per epoch.
+        :return: A tuple (train_res, valid_res) of Results with the average
+            loss and accuracy per epoch.
+        """
+        if in_memory:
+            dl_train = InMemoryLoader.from_loader(dl_train, shuffle=True)
+            dl_valid = InMemoryLoader.from_loader(dl_valid, shuffle=False)
 
-        Result = namedtuple('Result', 'accuracy loss')
         train_res = Result(accuracy=[], loss=[])
         valid_res = Result(accuracy=[], loss=[])
         
@@ -111,9 +157,10 @@ class LinearClassifier(object):
             # bias trick is done in the jupyter notebook
             for x,y in dl_train:
                 pred,class_scores = self.predict(x)
-                curr_loss = loss_fn.loss(x,y,class_scores,pred)
+                curr_loss, loss_grad = loss_fn.loss_and_grad(
+                    x, y, class_scores, bias=self.bias)
                 total_loss = total_loss + curr_loss
-                grad = learn_rate*loss_fn.grad() + weight_decay*self.weights
+                grad = learn_rate*loss_grad + weight_decay*self.weights
                                      
                 total_correct+=self.evaluate_accuracy(y,pred)
                 self.weights -= (1/x.shape[0])*grad
@@ -129,7 +176,8 @@ class LinearClassifier(object):
             # validate 
             for x,y in dl_valid:
                 pred,class_scores = self.predict(x)
-                curr_loss = loss_fn.loss(x,y,class_scores,pred)                
+                # The same loss as in training and in train_sweep()
+                curr_loss, _ = loss_fn.loss_and_grad(None, y, class_scores)
                 total_loss+=curr_loss
                 total_correct+=self.evaluate_accuracy(y,pred)                
             
@@ -149,6 +197,105 @@ class LinearClassifier(object):
         print('')
         return train_res, valid_res
 
+    def train_hogwild(self,
+                      dl_train: DataLoader,
+                      dl_valid: DataLoader,
+                      loss_fn: ClassifierLoss,
+                      learn_rate=0.1, weight_decay=0.001, max_epochs=100,
+                      n_procs=None):
+        """
+        Trains the classifier with minibatch SGD in several processes at
+        once, Hogwild-style: the training set is split into a shard per
+        process, and each process applies the updates of its minibatches to
+        weights in shared memory without any locking. Updates of different
+        processes may then overwrite each other, which for SGD only adds a
+        little noise.
+        After each epoch the processes wait while the weights are copied,
+        and the copy is evaluated on the validation set while they train the
+        next epoch. If a process exits early, e.g. after an exception or
+        when it's killed, the others are terminated and a RuntimeError is
+        raised.
+        :param dl_train: DataLoader of the training set, whose sampler
+            determines the samples to train on, e.g. one created by
+            create_train_validation_loaders(). Each process loads its shard
+            with the same batch size in random order, without worker
+            processes of its own.
+        :param dl_valid: DataLoader of the validation set.
+        :param loss_fn: The loss to train with.
+        :param learn_rate: Learning rate.
+        :param weight_decay: Weight of the L2 regularization.
+        :param max_epochs: Number of epochs to train.
+        :param n_procs: Number of training processes. Defaults to the number
+            of CPUs. torch's intra-op threads are divided between them.
+        :return: A tuple (train_res, valid_res) of Results, as returned by
+            train(). The training loss and accuracy are averaged over the
+            minibatches of all processes.
+        """
+        n_procs = n_procs or os.cpu_count() or 1
+        indices = list(dl_train.sampler)
+        weights = self.weights.clone().share_memory_()
+        # Sum of the losses and accuracies of the minibatches of each process
+        # and epoch, and their number.
+        stats = torch.zeros(n_procs, max_epochs, 3).share_memory_()
+
+        model = copy.copy(self)
+        model.weights = weights
+        # Each process releases epoch_done after an epoch, and then waits to
+        # acquire epoch_start before the next one.
+        epoch_done = mp.Semaphore(0)
+        epoch_start = mp.Semaphore(0)
+        n_threads = max(1, torch.get_num_threads() // n_procs)
+        procs = [
+            mp.Process(target=_hogwild_worker, args=(
+                model, create_loader(dl_train.dataset, indices[rank::n_procs],
+                                     dl_train.batch_size, num_workers=0),
+                loss_fn, learn_rate, weight_decay, max_epochs, stats[rank],
+                epoch_done, epoch_start, n_threads), daemon=True)
+            for rank in range(n_procs)
+        ]
+
+        train_res = Result(accuracy=[], loss=[])
+        valid_res = Result(accuracy=[], loss=[])
+        best_weights, best_correct = None, -1
+        print('Training', end='')
+        for proc in procs:
+            proc.start()
+        try:
+            for epoch_idx in range(max_epochs):
+                _wait_for_epoch(epoch_done, procs)
+                model.weights = weights.clone()
+                for _ in procs:
+                    epoch_start.release()
+
+                loss, accuracy, n_batches = stats[:, epoch_idx].sum(dim=0)
+                train_res.loss.append(loss / n_batches)
+                train_res.accuracy.append(accuracy / n_batches)
+
+                total_loss, total_correct = 0, 0
+                for x, y in dl_valid:
+                    pred, class_scores = model.predict(x)
+                    loss, _ = loss_fn.loss_and_grad(None, y, class_scores)
+                    total_loss += loss
+                    total_correct += self.evaluate_accuracy(y, pred)
+                valid_res.loss.append(total_loss / len(dl_valid))
+                valid_res.accuracy.append(total_correct / len(dl_valid))
+                if total_correct > best_correct:
+                    best_weights = model.weights
+                    best_correct = total_correct
+                print('.', end='')
+        except BaseException:
+            for proc in procs:
+                proc.terminate()
+            raise
+        finally:
+            for proc in procs:
+                proc.join()
+
+        if best_weights is not None:
+            self.weights = best_weights
+        print('')
+        return train_res, valid_res
+
     def weights_as_images(self, img_shape, has_bias=True):
         """
         Create tensor images from the weights, for visualization.
@@ -175,6 +322,174 @@ class LinearClassifier(object):
         return w_images
 
 
+def train_sweep(dl_train: DataLoader, dl_valid: DataLoader,
+                loss_fn: SVMHingeLoss, n_features, n_classes, configs,
+                max_epochs=100, bias=False):
+    """
+    Trains a LinearClassifier for each of several hyperparameter
+    configurations at once, with a single pass over the data per epoch.
+    The weights of all H configurations are stacked so that the scores of a
+    batch under all of them are a single matrix product, and the learning
+    rates and weight decays are applied as vectors.
+    :param dl_train: DataLoader of the training set.
+    :param dl_valid: DataLoader of the validation set.
+    :param loss_fn: The hinge loss to train with, whose loss_and_grad()
+        accepts the scores of all configurations at once.
+    :param n_features: Number or features in each sample.
+    :param n_classes: Number of classes samples can belong to.
+    :param configs: A sequence of H dicts with the keys returned by
+        hyperparams(): weight_std, learn_rate and weight_decay.
+    :param max_epochs: Number of epochs to train.
+    :param bias: Whether the classifiers add a bias themselves, see
+        LinearClassifier.
+    :return: A tuple (classifiers, train_results, valid_results) of lists
+        with, for each configuration, a LinearClassifier with the weights of
+        its epoch with the best validation accuracy and its train and
+        validation Results, as returned by LinearClassifier.train().
+    """
+    n_configs = len(configs)
+    weight_std, learn_rate, weight_decay = (
+        torch.tensor([config[name] for config in configs],
+                     dtype=torch.float32).view(1, n_configs, 1)
+        for name in ('weight_std', 'learn_rate', 'weight_decay')
+    )
+
+    # The weights are stored as (D, H, C), so that viewed as (D, H*C) they
+    # are the weights of a single linear classifier with H*C classes.
+    n_rows = n_features + int(bias)
+    weights = torch.randn(n_rows, n_configs, n_classes) * weight_std
+    best_weights = weights.clone()
+    best_correct = torch.full((n_configs,), -1.)
+
+    train_res = [Result(accuracy=[], loss=[]) for _ in configs]
+    valid_res = [Result(accuracy=[], loss=[]) for _ in configs]
+    print('Training', end='')
+    for epoch_idx in range(max_epochs):
+        for dl, results, is_train in ((dl_train, train_res, True),
+                                      (dl_valid, valid_res, False)):
+            total_loss = torch.zeros(n_configs)
+            total_correct = torch.zeros(n_configs)
+            for x, y in dl:
+                scores = _sweep_scores(x, weights, bias)
+                loss, grad = loss_fn.loss_and_grad(x if is_train else None,
+                                                   y, scores, bias=bias)
+                total_loss += loss
+                total_correct += (scores.argmax(dim=2) == y.unsqueeze(1)) \
+                    .float().mean(dim=0) * 100
+                if is_train:
+                    grad = learn_rate * grad + weight_decay * weights
+                    weights -= (1 / x.shape[0]) * grad
+
+            for i, result in enumerate(results):
+                result.loss.append(total_loss[i] / len(dl))
+                result.accuracy.append(total_correct[i] / len(dl))
+
+        # Keep the weights of the best epoch of each configuration, by the
+        # validation accuracy which was accumulated last.
+        improved = total_correct > best_correct
+        best_weights[:, improved] = weights[:, improved]
+        best_correct[improved] = total_correct[improved]
+        print('.', end='')
+    print('')
+
+    classifiers = []
+    for i in range(n_configs):
+        classifier = LinearClassifier(n_features, n_classes, bias=bias)
+        classifier.weights = best_weights[:, i].clone()
+        classifiers.append(classifier)
+    return classifiers, train_res, valid_res
+
+
+def benchmark_hogwild(dl_train: DataLoader, dl_valid: DataLoader,
+                     loss_fn: ClassifierLoss, n_features, n_classes,
+                     proc_counts=None, max_epochs=3, **train_kw):
+    """
+    Measures how the wall-clock time of a training epoch scales with the
+    number of processes of LinearClassifier.train_hogwild().
+    :param dl_train: DataLoader of the training set.
+    :param dl_valid: DataLoader of the validation set.
+    :param loss_fn: The loss to train with.
+    :param n_features: Number or features in each sample.
+    :param n_classes: Number of classes samples can belong to.
+    :param proc_counts: Numbers of processes to time, where 0 times train()
+        in the calling process. Defaults to auto_worker_counts(): 0 and
+        powers of two up to the number of CPUs.
+    :param max_epochs: Number of epochs trained with each number of
+        processes.
+    :param train_kw: Extra keyword arguments of the training methods, e.g.
+        learn_rate and bias.
+    :return: A dict mapping each number of processes to the average time of
+        an epoch in seconds, including starting the processes.
+    """
+    bias = train_kw.pop('bias', False)
+    epoch_times = {}
+    for n_procs in proc_counts or auto_worker_counts():
+        classifier = LinearClassifier(n_features, n_classes, bias=bias)
+        start = time.perf_counter()
+        if n_procs == 0:
+            classifier.train(dl_train, dl_valid, loss_fn,
+                             max_epochs=max_epochs, **train_kw)
+        else:
+            classifier.train_hogwild(dl_train, dl_valid, loss_fn,
+                                     max_epochs=max_epochs, n_procs=n_procs,
+                                     **train_kw)
+        epoch_times[n_procs] = (time.perf_counter() - start) / max_epochs
+    return epoch_times
+
+
+def _hogwild_worker(model: LinearClassifier, dl: DataLoader,
+                    loss_fn: ClassifierLoss, learn_rate, weight_decay,
+                    max_epochs, stats: Tensor, epoch_done, epoch_start,
+                    n_threads):
+    """
+    Trains a model whose weights are in shared memory on a shard of the
+    training set, as a process of LinearClassifier.train_hogwild().
+    :param stats: Tensor of shape (max_epochs, 3) in shared memory, to which
+        the sum of the losses and accuracies of each epoch's minibatches and
+        their number are written.
+    """
+    torch.set_num_threads(n_threads)
+    weights = model.weights
+    for epoch_idx in range(max_epochs):
+        for x, y in dl:
+            pred, class_scores = model.predict(x)
+            loss, loss_grad = loss_fn.loss_and_grad(
+                x, y, class_scores, bias=model.bias)
+            grad = learn_rate * loss_grad + weight_decay * weights
+            weights.sub_(grad, alpha=1 / x.shape[0])
+            stats[epoch_idx] += torch.tensor(
+                [float(loss), float(model.evaluate_accuracy(y, pred)), 1.])
+        epoch_done.release()
+        epoch_start.acquire()
+
+
+def _wait_for_epoch(epoch_done, procs):
+    """
+    Waits until every training process of LinearClassifier.train_hogwild()
+    finished its epoch.
+    :raise RuntimeError: If a process exited before, e.g. after an exception
+        or when it was killed.
+    """
+    for _ in procs:
+        while not epoch_done.acquire(timeout=HOGWILD_POLL_SECONDS):
+            if any(proc.exitcode is not None for proc in procs):
+                raise RuntimeError("A training process failed")
+
+
+def _sweep_scores(x: Tensor, weights: Tensor, bias):
+    """
+    :return: The class scores of each sample under each configuration, of
+        shape (N, H, C).
+    """
+    n_rows, n_configs, n_classes = weights.shape
+    flat_weights = weights.view(n_rows, n_configs * n_classes)
+    if bias:
+        scores = torch.addmm(flat_weights[0], x, flat_weights[1:])
+    else:
+        scores = x @ flat_weights
+    return scores.view(x.shape[0], n_configs, n_classes)
+
+
 def hyperparams():
 
 
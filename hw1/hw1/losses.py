@@ -15,13 +15,33 @@ class ClassifierLoss(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def grad(self):
+    def grad(self, bias=False):
         """
+        :param bias: Whether the model has a separate bias, i.e. the samples
+            of the last calculated loss weren't transformed by the bias trick
+            and the model's weights have an extra first row for the bias.
         :return: Gradient of the last calculated loss w.r.t. model
-            parameters, as a Tensor of shape (D, C).
+            parameters, as a Tensor of shape (D, C), or (D+1, C) with a bias.
         """
         pass
 
+    def loss_and_grad(self, x, y, x_scores, bias=False):
+        """
+        Calculates the loss and its gradient w.r.t. model parameters.
+        Subclasses may override this to compute both in a single pass.
+        :param x: Batch of samples in a Tensor of shape (N, D), or None to
+            only calculate the loss, e.g. on a validation set.
+        :param y: Ground-truth labels for these samples: (N,)
+        :param x_scores: The predicted class score for each sample: (N, C).
+        :param bias: Whether the model has a separate bias, see grad().
+        :return: A tuple (loss, grad) of the loss and of its gradient, as
+            returned by loss() and grad(). The gradient is None when x is.
+        """
+        loss = self.loss(x, y, x_scores, torch.argmax(x_scores, dim=1))
+        if x is None:
+            return loss, None
+        return loss, self.grad(bias=bias)
+
 
 class SVMHingeLoss(ClassifierLoss):
     def __init__(self, delta=1.0):
@@ -32,7 +52,8 @@ class SVMHingeLoss(ClassifierLoss):
         """
         Calculates the Hinge-loss for a batch of samples.
 
-        :param x: Batch of samples in a Tensor of shape (N, D).
+        :param x: Batch of samples in a Tensor of shape (N, D), which may be
+            a sparse COO or CSR tensor.
         :param y: Ground-truth labels for these samples: (N,)
         :param x_scores: The predicted class score for each sample: (N, C).
         :param y_predicted: The predicted class label for each sample: (N,).
@@ -64,16 +85,18 @@ class SVMHingeLoss(ClassifierLoss):
         binary = margins
         binary[margins>0] = 1
         self.grad_ctx['binary'] = binary
-        self.grad_ctx['data'] = x.t()
+        self.grad_ctx['data'] = x
         self.grad_ctx['GT'] = y
         # ========================
         loss = torch.mean(temp)
         return loss
 
-    def grad(self):
+    def grad(self, bias=False):
         """
         Calculates the gradient of the Hinge-loss w.r.t. parameters.
-        :return: The gradient, of shape (D, C).
+        :param bias: Whether the model has a separate bias, in the first row
+            of its weights.
+        :return: The gradient, of shape (D, C), or (D+1, C) with a bias.
 
         """
         # TODO:
@@ -88,8 +111,95 @@ class SVMHingeLoss(ClassifierLoss):
         binary[range(0,binary.shape[0]),y] = -row_sum.t()
         G = binary
         x =   self.grad_ctx['data']
-        grad = x@G
+        if bias:
+            # The bias acts as a feature which is always 1
+            grad = G.new_empty((x.shape[1] + 1, G.shape[1]))
+            torch.sum(G, dim=0, out=grad[0])
+            _t_mm(x, G, out=grad[1:])
+        else:
+            grad = _t_mm(x, G)
         grad = grad/len(y)
         # ========================
 
         return grad
+
+    def loss_and_grad(self, x, y, x_scores, bias=False):
+        """
+        Calculates the Hinge-loss and its gradient in a single pass, with the
+        margins and then the gradient's coefficients in one (N, C) buffer.
+        The in-place updates of the buffer mean that the loss can't be
+        differentiated by autograd; use loss() for that.
+        Scores of H models at once, e.g. from linear_classifier.train_sweep,
+        are also supported: their loss has shape (H,) and their gradient
+        shape (D, H, C).
+
+        :param x: Batch of samples in a Tensor of shape (N, D), which may be
+            a sparse COO or CSR tensor, or None to only calculate the loss.
+        :param y: Ground-truth labels for these samples: (N,)
+        :param x_scores: The predicted class score for each sample: (N, C),
+            or (N, H, C).
+        :param bias: Whether the model has a separate bias, in the first row
+            of its weights.
+        :return: A tuple (loss, grad) with the mean loss over the batch and
+            the gradient, of shape (D, C), or (D+1, C) with a bias. The
+            gradient is None when x is.
+        """
+        n = x_scores.shape[0]
+        y_idx = y.view(n, *[1] * (x_scores.dim() - 1)) \
+            .expand(*x_scores.shape[:-1], 1)
+
+        # Margin s_j - s_{y_i} + delta of each wrong class, and zero for the
+        # right one.
+        coef = x_scores - torch.gather(x_scores, -1, y_idx)
+        coef.add_(self.delta).scatter_(-1, y_idx, 0).clamp_(min=0)
+        loss = coef.sum(dim=-1).mean(dim=0)
+        if x is None:
+            return loss, None
+
+        # Each violated margin adds the sample to its class's gradient and
+        # subtracts it from the right class's.
+        coef.sign_()
+        coef.scatter_(-1, y_idx, -coef.sum(dim=-1, keepdim=True))
+        coef = coef.view(n, -1)
+        if bias:
+            # The bias acts as a feature which is always 1
+            grad = coef.new_empty((x.shape[1] + 1, coef.shape[1]))
+            torch.sum(coef, dim=0, out=grad[0])
+            _t_mm(x, coef, out=grad[1:])
+        else:
+            grad = _t_mm(x, coef)
+        grad.div_(n)
+        return loss, grad.view(-1, *x_scores.shape[1:])
+
+
+def _t_mm(x, g, out=None):
+    """
+    Calculates the product x^T g of a batch of samples and a dense matrix.
+    For sparse samples, each nonzero x[i, j] adds x[i, j] * g[i] to row j of
+    the product, so that the work is proportional to the number of nonzeros
+    rather than to N*D; torch's own products with transposed sparse tensors
+    first convert them.
+    :param x: Tensor of shape (N, D), dense or sparse COO or CSR.
+    :param g: Dense tensor of shape (N, K).
+    :param out: Optional dense tensor of shape (D, K) to write to.
+    :return: A dense tensor of shape (D, K).
+    """
+    if x.layout == torch.strided:
+        if out is None:
+            return torch.mm(x.t(), g)
+        return torch.mm(x.t(), g, out=out)
+
+    if x.layout == torch.sparse_csr:
+        rows = torch.repeat_interleave(x.crow_indices().diff())
+        cols = x.col_indices()
+    elif x.layout == torch.sparse_coo:
+        x = x.coalesce()
+        rows, cols = x.indices()
+    else:
+        raise ValueError(f"Unsupported sparse layout: {x.layout}")
+
+    if out is None:
+        out = g.new_zeros((x.shape[1], g.shape[1]))
+    else:
+        out.zero_()
+    return out.index_add_(0, cols, g[rows] * x.values().unsqueeze(1))
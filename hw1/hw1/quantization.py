@@ -0,0 +1,110 @@
+import torch
+from torch import Tensor
+
+# Reduced-precision storage formats of QuantizedTensor.
+STORAGE_TYPES = ('float16', 'int8')
+
+# Largest magnitude of a quantized int8 value.
+INT8_MAX = 127
+
+
+class QuantizedTensor(object):
+    """
+    A matrix of samples stored in reduced precision: either float16, or int8
+    with a float32 scale per row.
+    Indexing it along the first dimension returns the selected rows
+    dequantized to float32, so it can be used in place of a float32 tensor
+    by code which only reads blocks of rows, such as distances.l2_topk.
+    """
+
+    def __init__(self, data: Tensor, scales: Tensor = None):
+        """
+        :param data: The quantized values, a float16 or int8 tensor of shape
+            (N, D).
+        :param scales: For int8 data, the scale of each row, shape (N,).
+        """
+        if data.dtype == torch.int8 and scales is None:
+            raise ValueError("int8 data requires per-row scales")
+        self.data = data
+        self.scales = scales
+
+    @staticmethod
+    def quantize(x: Tensor, storage, block_rows=4096):
+        """
+        Quantizes a float matrix, a block of rows at a time.
+        :param x: Tensor of shape (N, D) to quantize.
+        :param storage: Storage format, one of STORAGE_TYPES.
+        :param block_rows: Number of rows to convert at a time.
+        :return: A QuantizedTensor.
+        """
+        if storage == 'float16':
+            return QuantizedTensor(x.to(torch.float16))
+        if storage != 'int8':
+            raise ValueError(f"Unknown storage: {storage}")
+
+        data = torch.empty(x.shape, dtype=torch.int8)
+        scales = torch.empty(x.shape[0], dtype=torch.float32)
+        for i in range(0, x.shape[0], block_rows):
+            block = x[i:i + block_rows].to(torch.float32)
+            # Symmetric quantization: each row's largest magnitude maps to
+            # INT8_MAX. All-zero rows get a scale of 1 to avoid dividing by 0.
+            block_scales = block.abs().max(dim=1)[0] / INT8_MAX
+            block_scales[block_scales == 0] = 1.
+            data[i:i + block_rows] = torch.round(
+                block / block_scales.unsqueeze(1))
+            scales[i:i + block_rows] = block_scales
+        return QuantizedTensor(data, scales)
+
+    @staticmethod
+    def cat(tensors):
+        """
+        Concatenates the rows of QuantizedTensors with the same storage.
+        :param tensors: A sequence of QuantizedTensors.
+        :return: A QuantizedTensor.
+        """
+        data = torch.cat([t.data for t in tensors], dim=0)
+        if tensors[0].scales is None:
+            return QuantizedTensor(data)
+        return QuantizedTensor(data, torch.cat([t.scales for t in tensors]))
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def dtype(self):
+        """
+        The dtype of dequantized values.
+        """
+        return torch.float32
+
+    @property
+    def storage(self):
+        return 'int8' if self.scales is not None else 'float16'
+
+    @property
+    def nbytes(self):
+        n = self.data.numel() * self.data.element_size()
+        if self.scales is not None:
+            n += self.scales.numel() * self.scales.element_size()
+        return n
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, index):
+        block = self.data[index].to(torch.float32)
+        if self.scales is not None:
+            block.mul_(self.scales[index].unsqueeze(-1))
+        return block
+
+    def index_select(self, dim, index: Tensor):
+        """
+        Selects rows without dequantizing them.
+        :param dim: Must be 0.
+        :param index: Indices of the rows to select.
+        :return: A QuantizedTensor with the selected rows.
+        """
+        assert dim == 0, "Only rows can be selected"
+        scales = None if self.scales is None else self.scales[index]
+        return QuantizedTensor(self.data[index], scales)
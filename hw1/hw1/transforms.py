@@ -15,6 +15,14 @@ class TensorView(object):
         return tensor.view(self.view_dims)
         # ========================
 
+    def apply_batch(self, x: torch.Tensor, inplace=False):
+        """
+        :param x: A batch of N samples, a tensor of shape (N,...).
+        :param inplace: Unused, views never copy.
+        :return: A view of shape (N, *view_dims).
+        """
+        return x.view(x.shape[0], *self.view_dims)
+
 
 class InvertColors(object):
     """
@@ -31,6 +39,16 @@ class InvertColors(object):
         return 1 - x
         # ========================
 
+    def apply_batch(self, x: torch.Tensor, inplace=False):
+        """
+        :param x: A batch of images, a tensor of shape (N,C,H,W).
+        :param inplace: Whether to invert x itself instead of a copy.
+        :return: The images with inverted colors.
+        """
+        if inplace:
+            return x.neg_().add_(1)
+        return 1 - x
+
 
 class FlipUpDown(object):
     def __call__(self, x: torch.Tensor):
@@ -43,6 +61,14 @@ class FlipUpDown(object):
         return torch.flip(x,[1])
         # ========================
 
+    def apply_batch(self, x: torch.Tensor, inplace=False):
+        """
+        :param x: A batch of images, a tensor of shape (N,C,H,W).
+        :param inplace: Unused, flipping always copies.
+        :return: The images, flipped around the horizontal axis.
+        """
+        return torch.flip(x, [2])
+
 
 class BiasTrick(object):
     """
@@ -65,9 +91,79 @@ class BiasTrick(object):
         #  Add a 1 at the beginning of the given tensor's feature dimension.
         #  Hint: See torch.cat().
         # ====== YOUR CODE: ======
-        ones_mat = torch.unsqueeze(torch.ones(x.shape[:-1],dtype=x.dtype),dim=-1)
-        out = torch.cat((ones_mat,x),dim=-1)
+        # Write the ones and the samples into a single new tensor, instead of
+        # allocating a tensor of ones and concatenating.
+        out = x.new_empty((*x.shape[:-1], x.shape[-1] + 1))
+        out[..., 0] = 1
+        out[..., 1:] = x
         return out
-        
-        #raise NotImplementedError()
         # ========================
+
+    def apply_batch(self, x: torch.Tensor, inplace=False):
+        """
+        :param x: A batch of N samples, a tensor of shape (N,D).
+        :param inplace: Unused, the samples are always copied into a new
+            (N,D+1) tensor.
+        :return: A tensor of shape (N,D+1) with a '1' prepended to each
+            sample.
+        """
+        return self(x)
+
+
+class BatchTransform(object):
+    """
+    Applies a sequence of the transforms in this module to whole batches of
+    samples, e.g. to the samples of each batch returned by a DataLoader,
+    instead of to one sample at a time.
+    The sequence is simplified when it's created: consecutive views are
+    merged into one, and pairs of color inversions or of flips within a run
+    of them cancel out, since they commute. Transforms which allocate their
+    output (flips and the bias trick) let the following ones run in place.
+    """
+
+    def __init__(self, *transforms, inplace=False):
+        """
+        :param transforms: Transforms to apply, in order. Each must have an
+            apply_batch() method.
+        :param inplace: Whether the first transforms may modify the input
+            batch itself, when it isn't needed afterwards.
+        """
+        self.transforms = _fuse(transforms)
+        self.inplace = inplace
+
+    def __call__(self, x: torch.Tensor):
+        """
+        :param x: A batch of N samples, a tensor of shape (N,...).
+        :return: The transformed batch.
+        """
+        # Whether x is a tensor the caller allowed modifying or that was
+        # allocated here.
+        owned = self.inplace
+        for transform in self.transforms:
+            x = transform.apply_batch(x, inplace=owned)
+            owned = owned or not isinstance(transform, TensorView)
+        return x
+
+
+def _fuse(transforms):
+    fused = []
+    run = []
+    for transform in list(transforms) + [None]:
+        if isinstance(transform, (InvertColors, FlipUpDown)):
+            run.append(transform)
+            continue
+
+        # Flip first, so that the inversion can run in place on its output
+        n_flips = sum(isinstance(t, FlipUpDown) for t in run)
+        if n_flips % 2:
+            fused.append(FlipUpDown())
+        if (len(run) - n_flips) % 2:
+            fused.append(InvertColors())
+        run = []
+
+        if isinstance(transform, TensorView) and fused and \
+                isinstance(fused[-1], TensorView):
+            fused[-1] = transform
+        elif transform is not None:
+            fused.append(transform)
+    return fused
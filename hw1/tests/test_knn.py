@@ -0,0 +1,250 @@
+import pytest
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+from hw1.chunked import ChunkedTensor
+from hw1.knn_classifier import KNNClassifier
+from hw1.knn_executor import KNNQueryExecutor
+from hw1.quantization import QuantizedTensor
+
+
+N_TRAIN = 5000
+N_ADDED = 15000
+N_TEST = 2000
+N_FEATURES = 3
+N_CLASSES = 10
+K = 5
+
+BACKENDS = [
+    dict(backend='brute'),
+    dict(backend='kdtree'),
+    dict(backend='balltree'),
+    # Probing every list makes IVF search exact
+    dict(backend='ivf', n_lists=8, nprobe=8),
+]
+
+
+@pytest.fixture(scope='module')
+def data():
+    gen = torch.Generator().manual_seed(42)
+    x = torch.randn(N_TRAIN + N_ADDED, N_FEATURES, generator=gen)
+    y = torch.randint(0, N_CLASSES, (N_TRAIN + N_ADDED,), generator=gen)
+    x_test = torch.randn(N_TEST, N_FEATURES, generator=gen)
+    return x, y, x_test
+
+
+def brute_predict(x, y, x_test):
+    return KNNClassifier(K).train_tensors(x, y, n_classes=N_CLASSES) \
+        .predict(x_test)
+
+
+def trained_model(data, backend_kw, **kw):
+    x, y, _ = data
+    model = KNNClassifier(K, **backend_kw, **kw)
+    model.train_tensors(x[:N_TRAIN], y[:N_TRAIN])
+    ids = model.add(x[N_TRAIN:], y[N_TRAIN:])
+    assert torch.equal(ids, torch.arange(N_TRAIN, N_TRAIN + N_ADDED))
+    return model
+
+
+class TestChunkedTensor(object):
+
+    def test_append(self):
+        x = torch.randn(50, 4)
+        chunked = ChunkedTensor(x[:10], chunk_rows=8)
+        for start, end in ((10, 13), (13, 30), (30, 31), (31, 50)):
+            chunked.append(x[start:end])
+
+        assert chunked.shape == x.shape
+        assert len(chunked) == len(x)
+        assert torch.equal(chunked[:], x)
+        assert torch.equal(chunked[5:45], x[5:45])
+        assert torch.equal(chunked[-1], x[-1])
+
+    def test_index_select(self):
+        x = torch.randn(50, 4)
+        chunked = ChunkedTensor(x[:20], chunk_rows=8)
+        chunked.append(x[20:])
+        idx = torch.tensor([49, 0, 25, 7, 7, -1])
+
+        assert torch.equal(chunked.index_select(0, idx), x[idx])
+        assert torch.equal(chunked[idx], x[idx])
+
+    def test_quantized(self):
+        x = torch.randn(30, 4)
+        chunked = ChunkedTensor(QuantizedTensor.quantize(x[:20], 'int8'))
+        chunked.append(QuantizedTensor.quantize(x[20:], 'int8'))
+        selected = chunked.index_select(0, torch.tensor([25, 3]))
+
+        assert isinstance(selected, QuantizedTensor)
+        assert torch.allclose(selected[:], x[[25, 3]], atol=0.05)
+
+    def test_head(self):
+        x = torch.randn(30, 4)
+        chunked = ChunkedTensor(x[:10], chunk_rows=8)
+        chunked.append(x[10:13])
+        head = chunked.head(12)
+        chunked.append(x[13:])
+
+        assert torch.equal(head[:], x[:12])
+        assert torch.equal(chunked[:], x)
+
+
+class TestKNNUpdates(object):
+
+    @pytest.mark.parametrize('backend_kw', BACKENDS)
+    def test_add(self, data, backend_kw):
+        x, y, x_test = data
+        model = trained_model(data, backend_kw)
+
+        assert torch.equal(model.predict(x_test),
+                           brute_predict(x, y, x_test))
+
+    @pytest.mark.parametrize('backend_kw', BACKENDS)
+    def test_remove(self, data, backend_kw):
+        x, y, x_test = data
+        model = trained_model(data, backend_kw, compact_ratio=None)
+        removed = torch.arange(0, N_TRAIN + N_ADDED, 3)
+        model.remove(removed)
+        live = torch.ones(len(x), dtype=torch.bool)
+        live[removed] = False
+
+        assert model.n_removed == len(removed)
+        assert torch.equal(model.predict(x_test),
+                           brute_predict(x[live], y[live], x_test))
+        with pytest.raises(ValueError):
+            model.remove(removed[:1])
+
+    @pytest.mark.parametrize('backend_kw', BACKENDS)
+    def test_remove_nearest(self, data, backend_kw):
+        x, y, x_test = data
+        model = trained_model(data, backend_kw, compact_ratio=None)
+        model.predict(x_test)
+
+        # Few enough samples that trees aren't rebuilt, but all of them
+        # near the queries.
+        _, nearest = KNNClassifier(K).train_tensors(x, y) \
+            .kneighbors(x_test[:200], 2 * K)
+        removed = torch.unique(nearest.flatten())
+        model.remove(removed)
+        live = torch.ones(len(x), dtype=torch.bool)
+        live[removed] = False
+
+        assert torch.equal(model.predict(x_test),
+                           brute_predict(x[live], y[live], x_test))
+
+    @pytest.mark.parametrize('backend_kw', BACKENDS)
+    def test_compact(self, data, backend_kw):
+        x, y, x_test = data
+        model = trained_model(data, backend_kw, compact_ratio=None)
+        removed = torch.arange(1, N_TRAIN + N_ADDED, 4)
+        model.remove(removed)
+        model.compact()
+        live = torch.ones(len(x), dtype=torch.bool)
+        live[removed] = False
+
+        assert model.n_removed == 0
+        assert torch.equal(model.ids, live.nonzero().flatten())
+        assert torch.equal(model.predict(x_test),
+                           brute_predict(x[live], y[live], x_test))
+
+    @pytest.mark.parametrize('backend_kw', BACKENDS)
+    def test_background_compaction(self, data, backend_kw):
+        x, y, x_test = data
+        model = trained_model(data, backend_kw, compact_ratio=0.1)
+        removed = torch.arange(0, N_TRAIN + N_ADDED, 5)
+        model.remove(removed)
+        compaction = model._compaction
+        assert compaction is not None
+
+        # Samples added and removed during the compaction are kept up
+        model.remove(removed[:10] + 1)
+        model.add(x[:10] + 100, y[:10])
+        compaction.join()
+        model.remove(removed[10:20] + 1)
+        live = torch.ones(len(x), dtype=torch.bool)
+        live[removed] = False
+        live[removed[:20] + 1] = False
+
+        assert torch.equal(model.predict(x_test),
+                           brute_predict(x[live], y[live], x_test))
+
+    @pytest.mark.parametrize('backend_kw', BACKENDS)
+    def test_executor(self, data, backend_kw):
+        x, y, x_test = data
+        expected = brute_predict(x, y, x_test)
+
+        # Searches of indexes which are updated lazily, e.g. trees which
+        # hold fewer samples than were added, first update them.
+        model = trained_model(data, backend_kw)
+        executor = KNNQueryExecutor(model, n_workers=8, shard_size=100)
+
+        assert torch.equal(executor.predict(x_test), expected)
+
+
+class TestTies(object):
+
+    @pytest.mark.parametrize('backend_kw', [
+        *BACKENDS, dict(backend='brute', max_tile_bytes=64 * 1024)])
+    def test_ties_by_index(self, backend_kw):
+        # Few distinct samples, so that most neighbors are tied
+        gen = torch.Generator().manual_seed(42)
+        x = torch.randint(0, 6, (N_TRAIN + N_ADDED, N_FEATURES),
+                          generator=gen).float()
+        y = torch.randint(0, N_CLASSES, (N_TRAIN + N_ADDED,), generator=gen)
+        x_test = torch.randint(0, 6, (N_TEST, N_FEATURES),
+                               generator=gen).float()
+        model = trained_model((x, y, x_test), backend_kw, compact_ratio=None)
+        removed = torch.arange(0, N_TRAIN + N_ADDED, 7)
+        model.remove(removed)
+
+        dists = torch.cdist(x_test, x).pow_(2).round_()
+        dists[:, removed] = float('inf')
+        _, expected = torch.sort(dists, dim=1, stable=True)
+
+        _, idx = model.kneighbors(x_test)
+        assert torch.equal(idx, expected[:, :K])
+
+
+class TestStorage(object):
+
+    @pytest.mark.parametrize('storage', ['float16', 'int8'])
+    def test_train(self, data, storage):
+        x, y, x_test = data
+        dl = DataLoader(TensorDataset(x, y), batch_size=1000)
+        model = KNNClassifier(K, storage=storage).train(dl)
+        expected = KNNClassifier(K, storage=storage).train_tensors(x, y)
+
+        assert isinstance(model.x_train, QuantizedTensor)
+        assert torch.equal(model.y_train, y)
+        assert torch.equal(model.predict(x_test), expected.predict(x_test))
+
+
+class TestSaveLoad(object):
+
+    @pytest.mark.parametrize('storage', [None, 'float16', 'int8'])
+    def test_round_trip(self, data, tmpdir, storage):
+        x, y, x_test = data
+        model = trained_model(data, dict(backend='brute'), storage=storage)
+        model.remove(torch.arange(0, N_TRAIN + N_ADDED, 3))
+        expected = model.predict(x_test)
+        path = str(tmpdir)
+
+        model.save(path)
+        loaded = KNNClassifier.load(path)
+        # Saving over the files the model is mapped from
+        loaded.save(path)
+        reloaded = KNNClassifier.load(path)
+
+        for m in (loaded, reloaded):
+            assert torch.equal(m.ids, model.ids)
+            assert torch.equal(m.predict(x_test), expected)
+
+    def test_overwrite_storage(self, data, tmpdir):
+        x, y, x_test = data
+        path = str(tmpdir)
+        KNNClassifier(K, storage='int8').train_tensors(x, y).save(path)
+        KNNClassifier(K).train_tensors(x, y).save(path)
+
+        assert torch.equal(KNNClassifier.load(path).predict(x_test),
+                           brute_predict(x, y, x_test))